@@ -39,8 +39,8 @@ import vtk.util.numpy_support as VN
 import numpy as np
 import numpy.matlib
 import scipy.io as sio
-from scipy.interpolate import griddata
-from scipy.spatial.distance import pdist, squareform
+from concurrent.futures import ThreadPoolExecutor
+from scipy.interpolate import LinearNDInterpolator
 from matplotlib import path
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from PyQt5 import QtCore, QtGui, QtWidgets
@@ -146,6 +146,9 @@ class ali_avg(object):
         mirrorLabel.setFont(headFont)
         self.mirrorXbutton = QtWidgets.QPushButton('ZY')
         self.mirrorYbutton = QtWidgets.QPushButton('ZX')
+        self.autoMirrorButton = QtWidgets.QPushButton('Auto')
+        self.autoMirrorButton.setToolTip('Align each mirror candidate concurrently and apply the one with the lowest residual')
+        self.flipsCheck = QtWidgets.QCheckBox('Include 180\u00b0 flips')
 
         horizLine2=QtWidgets.QFrame()
         horizLine2.setFrameStyle(QtWidgets.QFrame.HLine)
@@ -178,12 +181,21 @@ class ali_avg(object):
         alignAlgoButtonGroup = QtWidgets.QButtonGroup()
         self.useVTKalignButton=QtWidgets.QRadioButton("VTK ICP")
         self.useICPalignButton=QtWidgets.QRadioButton("K-neighbour ICP")
+        self.useTrimmedICPalignButton=QtWidgets.QRadioButton("Trimmed ICP")
         self.useVTKalignButton.setChecked(True)
         alignAlgoButtonGroup.addButton(self.useVTKalignButton)
         alignAlgoButtonGroup.addButton(self.useICPalignButton)
+        alignAlgoButtonGroup.addButton(self.useTrimmedICPalignButton)
+        self.keepLabel=QtWidgets.QLabel("Keep (%):")
+        self.keepPercent = QtWidgets.QDoubleSpinBox()
+        self.keepPercent.setMaximum(100)
+        self.keepPercent.setMinimum(10)
+        self.keepPercent.setValue(90)
+        self.huberCheck=QtWidgets.QCheckBox("Huber weighting")
         alignAlgoButtonGroup.setExclusive(True)
         self.X180Button = QtWidgets.QPushButton("Flip X")
         self.Y180Button = QtWidgets.QPushButton("Flip Y")
+        self.initPoseButton = QtWidgets.QPushButton("Find initial pose")
         self.alignButton = QtWidgets.QPushButton("Align")
         self.acceptAlignButton = QtWidgets.QPushButton("Accept")
         
@@ -204,6 +216,11 @@ class ali_avg(object):
         self.averageButton = QtWidgets.QPushButton('Average')
         self.averageButton.setStyleSheet("background-color : None ")
         
+        #widgets for displaying averaging statistics
+        avgDisplayLabel=QtWidgets.QLabel("Display:")
+        self.avgDisplay = QtWidgets.QComboBox()
+        self.avgDisplay.addItems(['Average','Half-difference','Standard deviation','Sample count'])
+        
         horizLine4=QtWidgets.QFrame()
         horizLine4.setFrameStyle(QtWidgets.QFrame.HLine)
         self.writeButton=QtWidgets.QPushButton('Write')
@@ -219,35 +236,45 @@ class ali_avg(object):
         mainUiBox.addWidget(mirrorLabel,3,0,1,2)
         mainUiBox.addWidget(self.mirrorYbutton,4,0,1,1)
         mainUiBox.addWidget(self.mirrorXbutton,4,1,1,1)
-        mainUiBox.addWidget(horizLine2,5,0,1,2)
-        mainUiBox.addWidget(alignLabel,6,0,1,2)
-        mainUiBox.addWidget(self.centRefButton,7,0,1,2)
-        mainUiBox.addWidget(self.centFloatButton,8,0,1,2)
-        mainUiBox.addWidget(self.transXlabel,9,0,1,1)
-        mainUiBox.addWidget(self.transX,9,1,1,1)
-        mainUiBox.addWidget(self.transYlabel,10,0,1,1)
-        mainUiBox.addWidget(self.transY,10,1,1,1)
-        mainUiBox.addWidget(self.rotateZlabel,11,0,1,1)
-        mainUiBox.addWidget(self.rotateZ,11,1,1,1)
-        mainUiBox.addWidget(self.transButton,12,0,1,2)
-        mainUiBox.addWidget(self.X180Button,13,0,1,1)
-        mainUiBox.addWidget(self.Y180Button,13,1,1,1)
-        mainUiBox.addWidget(self.numPntsOutline,14,0,1,1)
-        mainUiBox.addWidget(self.reduceOutlineButton,14,1,1,1)
-        
-        mainUiBox.addWidget(self.useVTKalignButton,15,0,1,1)
-        mainUiBox.addWidget(self.useICPalignButton,15,1,1,1)
-
-        mainUiBox.addWidget(self.alignButton,16,0,1,1)
-        mainUiBox.addWidget(self.acceptAlignButton,16,1,1,1)
-        mainUiBox.addWidget(horizLine3,17,0,1,2)
-        mainUiBox.addWidget(averageLabel,18,0,1,2)
-        mainUiBox.addWidget(gridLabel,19,0,1,1)
-        mainUiBox.addWidget(self.gridInd,19,1,1,1)
-        mainUiBox.addWidget(self.averageButton,20,0,1,2)
-        mainUiBox.addWidget(horizLine4,21,0,1,2)
-        mainUiBox.addWidget(self.writeButton,22,0,1,2)
-        mainUiBox.addWidget(horizLine5,23,0,1,2)
+        mainUiBox.addWidget(self.autoMirrorButton,5,0,1,1)
+        mainUiBox.addWidget(self.flipsCheck,5,1,1,1)
+        mainUiBox.addWidget(horizLine2,6,0,1,2)
+        mainUiBox.addWidget(alignLabel,7,0,1,2)
+        mainUiBox.addWidget(self.centRefButton,8,0,1,2)
+        mainUiBox.addWidget(self.centFloatButton,9,0,1,2)
+        mainUiBox.addWidget(self.transXlabel,10,0,1,1)
+        mainUiBox.addWidget(self.transX,10,1,1,1)
+        mainUiBox.addWidget(self.transYlabel,11,0,1,1)
+        mainUiBox.addWidget(self.transY,11,1,1,1)
+        mainUiBox.addWidget(self.rotateZlabel,12,0,1,1)
+        mainUiBox.addWidget(self.rotateZ,12,1,1,1)
+        mainUiBox.addWidget(self.transButton,13,0,1,2)
+        mainUiBox.addWidget(self.X180Button,14,0,1,1)
+        mainUiBox.addWidget(self.Y180Button,14,1,1,1)
+        mainUiBox.addWidget(self.initPoseButton,15,0,1,2)
+        mainUiBox.addWidget(self.numPntsOutline,16,0,1,1)
+        mainUiBox.addWidget(self.reduceOutlineButton,16,1,1,1)
+        
+        mainUiBox.addWidget(self.useVTKalignButton,17,0,1,1)
+        mainUiBox.addWidget(self.useICPalignButton,17,1,1,1)
+
+        mainUiBox.addWidget(self.useTrimmedICPalignButton,18,0,1,1)
+        mainUiBox.addWidget(self.huberCheck,18,1,1,1)
+        mainUiBox.addWidget(self.keepLabel,19,0,1,1)
+        mainUiBox.addWidget(self.keepPercent,19,1,1,1)
+
+        mainUiBox.addWidget(self.alignButton,20,0,1,1)
+        mainUiBox.addWidget(self.acceptAlignButton,20,1,1,1)
+        mainUiBox.addWidget(horizLine3,21,0,1,2)
+        mainUiBox.addWidget(averageLabel,22,0,1,2)
+        mainUiBox.addWidget(gridLabel,23,0,1,1)
+        mainUiBox.addWidget(self.gridInd,23,1,1,1)
+        mainUiBox.addWidget(self.averageButton,24,0,1,2)
+        mainUiBox.addWidget(avgDisplayLabel,25,0,1,1)
+        mainUiBox.addWidget(self.avgDisplay,25,1,1,1)
+        mainUiBox.addWidget(horizLine4,26,0,1,2)
+        mainUiBox.addWidget(self.writeButton,27,0,1,2)
+        mainUiBox.addWidget(horizLine5,28,0,1,2)
         # mainUiBox.addWidget(self.statusLabel,18,0,1,2)
 
         mainUiBox.setColumnMinimumWidth(0,mainUiBox.columnMinimumWidth(0))
@@ -301,14 +328,17 @@ class aa_interactor(QtWidgets.QWidget):
         # self.ui.reloadButton.clicked.connect(lambda: self.get_input_data(None))
         self.ui.mirrorXbutton.clicked.connect(lambda: self.flipside('x'))
         self.ui.mirrorYbutton.clicked.connect(lambda: self.flipside('y'))
+        self.ui.autoMirrorButton.clicked.connect(lambda: self.auto_mirror())
         self.ui.centRefButton.clicked.connect(lambda: self.zero_pos('ref'))
         self.ui.centFloatButton.clicked.connect(lambda: self.zero_pos('float'))
         self.ui.transButton.clicked.connect(lambda: self.shift())
         self.ui.X180Button.clicked.connect(lambda: self.flip('x'))
         self.ui.Y180Button.clicked.connect(lambda: self.flip('y'))
+        self.ui.initPoseButton.clicked.connect(lambda: self.init_pose())
         self.ui.alignButton.clicked.connect(lambda: self.align())
         self.ui.acceptAlignButton.clicked.connect(lambda: self.accept_align())
         self.ui.averageButton.clicked.connect(lambda: self.average())
+        self.ui.avgDisplay.currentIndexChanged.connect(lambda: self.display_avg())
         self.ui.writeButton.clicked.connect(lambda: self.write())
         self.ui.reduceOutlineButton.clicked.connect(lambda: self.reduce_outline())
     
@@ -486,6 +516,50 @@ class aa_interactor(QtWidgets.QWidget):
         self.update_limits()
         
         
+    def init_pose(self):
+        '''
+        Applies the global initial pose from initial_pose to the floating dataset, including a mirror operation if this improves the match, ready for align
+        '''
+        self.unsaved_changes=True
+        
+        if self.averaged == True: #then set it false and change the button
+            self.averaged = False
+            self.ui.averageButton.setStyleSheet("background-color : None ")
+        
+        if self.aligned == True: #then set it false and change the button
+            self.aligned = False
+            self.ui.alignButton.setStyleSheet("background-color : None ")
+        
+        self.ui.statLabel.setText("Searching for initial pose . . .")
+        QtWidgets.QApplication.processEvents()
+        
+        #mirror candidate reverses the current mirror operation if there is one
+        if self.mirrored:
+            plane=self.mirror_plane
+        else: plane="x"
+        axis={"x":0,"y":1}[plane]
+        
+        T,mirrored,score=initial_pose(self.fO_local,self.rO_local,mirror_axis=axis)
+        if mirrored:
+            self.flipside(plane)
+            M=np.identity(4)
+            M[axis,axis]=-1
+            T=np.dot(T,M)
+        
+        #icp form to apply_trans form
+        T[0:3,0:3]=T[0:3,0:3].T
+        self.floatTrans.append(T)
+        
+        #apply operation
+        self.flp=apply_trans(self.flp,T)
+        self.fO=apply_trans(self.fO,T)
+        self.fO_local=apply_trans(self.fO_local,T)
+        
+        self.update_float()
+        self.update_limits()
+        self.ren.ResetCamera()
+        self.ui.statLabel.setText("Initial pose applied with an overlap score of %0.2f."%score)
+    
     def write(self):
         
         mat_vars=sio.whosmat(self.fileo)
@@ -497,11 +571,23 @@ class aa_interactor(QtWidgets.QWidget):
                 return
             else:
                 #delete fitting parameters with pyCMcommon helper function, which negates FEA pre-processing as well.
-                clear_mat(self.fileo,['x_out','aa_mask','spline_x']) 
+                clear_mat(self.fileo,['x_out','aa_mask','spline_x','fit_x','fit_residual'])
 
         mat_contents=sio.loadmat(self.fileo)
         
-        new={'trans': {'ref':self.refTrans, 'float':self.floatTrans},'aa': {'pnts': self.ap, 'gsize': self.gsize}}
+        if self.raster is not None:
+            #only valid cells are stored, in row-major order, statistics in single precision
+            mask=self.raster['mask']
+            aa={'z':self.raster['z'][mask], 'shape':np.array(mask.shape), 'origin':self.raster['origin'], \
+                'spacing':self.raster['spacing'], 'mask':np.packbits(mask), 'gsize':self.gsize}
+            for field in ['diff','std']:
+                if field in self.raster:
+                    aa[field]=self.raster[field][mask].astype(np.float32)
+            if 'count' in self.raster:
+                aa['count']=self.raster['count'][mask].astype(np.uint8)
+        else: #legacy data that hasn't been averaged again
+            aa={'pnts': self.ap, 'gsize': self.gsize}
+        new={'trans': {'ref':self.refTrans, 'float':self.floatTrans},'aa': aa}
         
         mat_contents.update(new) #update the dictionary
             
@@ -509,12 +595,31 @@ class aa_interactor(QtWidgets.QWidget):
         self.ui.statLabel.setText("Wrote data.")
         self.unsaved_changes=False
         
+    def get_interpolators(self,tT):
+        '''
+        Returns linear interpolators for the reference and floating points, which are only triangulated again if the net transformation of either dataset has changed since they were last built. tT is an offset that has been temporarily applied to both datasets.
+        '''
+        key=compose_trans(self.refTrans).tobytes()+compose_trans(self.floatTrans).tobytes()
+        if self.interp_cache is None or self.interp_cache[0]!=key:
+            self.ui.statLabel.setText("Averaging, triangulating . . .")
+            QtWidgets.QApplication.processEvents()
+            def build(d):
+                interp=LinearNDInterpolator(d[:,:2]+tT[:2],d[:,-1])
+                interp.tri.transform #barycentric transforms are otherwise computed lazily on first use
+                return interp
+            with ThreadPoolExecutor(max_workers=2) as ex:
+                interps = list(ex.map(build,(self.rp,self.flp)))
+            self.interp_cache=(key,interps)
+        return self.interp_cache[1]
+    
     def average(self):
         
         self.unsaved_changes=True
         
         if hasattr(self,'aActor'):
             self.ren.RemoveActor(self.aActor)
+        if hasattr(self,'dActor'):
+            self.ren.RemoveActor(self.dActor)
         
         self.ui.statLabel.setText("Averaging, applying grid . . .")
         QtWidgets.QApplication.processEvents()
@@ -538,42 +643,52 @@ class aa_interactor(QtWidgets.QWidget):
         
         #populate grid size if attribute doesn't exist
         if not hasattr(self,'gsize'):
-            gs=squareform(pdist(windowed,'euclidean')) 
-            self.gsize = np.mean(np.sort(gs)[:,1])
+            self.gsize = nn_spacing(windowed)
             self.ui.gridInd.setValue(self.gsize)
         else:
             self.gsize=self.ui.gridInd.value()
         
-        #grid the reference based on gsize, bumping out the grid by 10% in either direction
-        grid_x, grid_y = np.meshgrid(
-        np.linspace(1.1*RefMin[0],1.1*RefMax[0],int((1.1*RefMax[0]-1.1*RefMin[0])/self.gsize)),
-        np.linspace(1.1*RefMin[1],1.1*RefMax[1],int((1.1*RefMax[1]-1.1*RefMin[1])/self.gsize)), 
-        indexing='xy')
-        
-        #apply the grid to the reference data
-        grid_Ref=griddata(self.rp[:,:2],self.rp[:,-1],(grid_x,grid_y),method='linear')
+        #grid the reference based on gsize
+        gx, gy = avg_grid(self.rO,self.gsize)
+        grid_x, grid_y = np.meshgrid(gx, gy, indexing='xy')
         
-        #apply the grid to the aligned data
-        grid_Align=griddata(self.flp[:,:2],self.flp[:,-1],(grid_x,grid_y),method='linear')
+        #apply the grid to the reference and aligned data, interpolators were built on the unshifted data
+        rInterp, fInterp = self.get_interpolators(tT)
+        self.acc=grid_accumulator(grid_x.shape)
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            grid_Ref, grid_Align = ex.map(lambda f: f(grid_x+tT[0],grid_y+tT[1]),(rInterp,fInterp))
+        for grid_z in (grid_Ref, grid_Align):
+            self.acc.add(grid_z)
         
         self.ui.statLabel.setText("Averaging using grid . . .")
         QtWidgets.QApplication.processEvents()
         
-        #average z values
-        grid_Avg=(grid_Ref+grid_Align)/2
+        #average z values where both datasets are present
+        grid_Avg=self.acc.mean(min_count=2)
         
-        #make sure that there isn't anything averaged outside the floating outline
-        p=path.Path(self.rO[:,:2])
-        inTest=np.hstack((np.ravel(grid_x.T)[np.newaxis].T,np.ravel(grid_y.T)[np.newaxis].T))
-        inOutline=p.contains_points(inTest)
+        #make sure that there isn't anything averaged outside the reference outline
+        inOutline=poly_mask(self.rO,gx,gy)
+        mask=np.logical_and(inOutline,~np.isnan(grid_Avg))
+        grid_Avg[~mask]=np.nan
+        
+        #disagreement between halves
+        grid_Diff=(grid_Ref-grid_Align)/2
+        grid_Std=self.acc.std()
+        grid_Diff[~mask], grid_Std[~mask] = np.nan, np.nan
         
-        #averaged points
-        self.ap = np.hstack((inTest[inOutline,:], \
-                    np.ravel(grid_Avg.T)[np.newaxis].T[inOutline]))
-                    
         #move everything back to original location
-        self.rO, self.fO, self.rp, self.flp, self.ap = \
-        self.rO+tT, self.fO+tT, self.rp+tT, self.flp+tT, self.ap+tT
+        self.rO, self.fO, self.rp, self.flp = \
+        self.rO+tT, self.fO+tT, self.rp+tT, self.flp+tT
+        
+        #averaged raster and points
+        self.raster={'z':grid_Avg,
+            'origin':np.array([gx[0],gy[0]])+tT[:2],
+            'spacing':np.array([gx[1]-gx[0],gy[1]-gy[0]]),
+            'mask':mask,
+            'diff':grid_Diff,
+            'std':grid_Std,
+            'count':self.acc.count.astype(np.uint8)}
+        self.ap=raster_to_pnts(grid_Avg,self.raster['origin'],self.raster['spacing'],mask)
         
         self.ui.statLabel.setText("Rendering . . .")
         QtWidgets.QApplication.processEvents()
@@ -588,6 +703,9 @@ class aa_interactor(QtWidgets.QWidget):
         self.aActor.SetScale(s)
         self.aActor.Modified()
         
+        if self.ui.avgDisplay.currentIndex()!=0:
+            self.display_avg()
+        
         #update
         self.ui.vtkWidget.update()
         self.ui.vtkWidget.setFocus()
@@ -596,6 +714,33 @@ class aa_interactor(QtWidgets.QWidget):
         self.ui.averageButton.setStyleSheet("background-color :rgb(77, 209, 97);")
         
     
+    def display_avg(self):
+        '''
+        Shows either the averaged points or one of the per-cell averaging statistics as a colour-mapped point cloud
+        '''
+        if hasattr(self,'dActor'):
+            self.ren.RemoveActor(self.dActor)
+            del self.dActor
+        if not hasattr(self,'aActor'):
+            return
+        
+        field=[None,'diff','std','count'][self.ui.avgDisplay.currentIndex()]
+        if field is None or self.raster is None or field not in self.raster:
+            self.aActor.VisibilityOn()
+            if field is not None:
+                self.ui.statLabel.setText("Statistics are not available for this dataset, re-average to generate them.")
+            self.ui.vtkWidget.update()
+            return
+        
+        values=self.raster[field][self.raster['mask']]
+        _, self.dActor, _, = gen_scalar_point_cloud(self.ap,values,self.PointSize,field)
+        s,_,_=self.get_scale()
+        self.dActor.SetScale(s)
+        self.aActor.VisibilityOff()
+        self.ren.AddActor(self.dActor)
+        self.ui.statLabel.setText("Showing %s: min %0.4f, max %0.4f."%(self.ui.avgDisplay.currentText().lower(),np.nanmin(values),np.nanmax(values)))
+        self.ui.vtkWidget.update()
+    
     def flipside(self,flipDirection):
         self.ui.statLabel.setText("Starting mirroring . . .")
         self.ui.vtkWidget.update()
@@ -656,6 +801,87 @@ class aa_interactor(QtWidgets.QWidget):
         self.ren.ResetCamera()
         self.ui.statLabel.setText("Mirror operation complete.")
     
+    def mirror_matrix(self,plane):
+        '''
+        Returns the homogeneous matrix that flipside(plane) applies to the floating data in its current mirror state
+        '''
+        M=np.identity(4)
+        if plane is None:
+            return M
+        if self.mirrored and self.mirror_plane != plane: #reverses the existing mirror too
+            M[0,0],M[1,1]=-1,-1
+        else:
+            ind={"x":0,"y":1}[plane]
+            M[ind,ind]=-1
+        return M
+    
+    def auto_mirror(self):
+        '''
+        Aligns the floating outline to the reference for each mirror candidate (and optionally each 180 degree flip) concurrently, applying the candidate and alignment with the lowest residual
+        '''
+        self.unsaved_changes=True
+        
+        if self.averaged == True: #then set it false and change the button
+            self.averaged = False
+            self.ui.averageButton.setStyleSheet("background-color : None ")
+            
+        if self.aligned == True: #then set it false and change the button
+            self.aligned = False
+            self.ui.alignButton.setStyleSheet("background-color : None ")
+        
+        self.ui.statLabel.setText("Aligning mirror candidates . . .")
+        QtWidgets.QApplication.processEvents()
+        
+        keep,huber=1.0,None
+        if self.ui.useTrimmedICPalignButton.isChecked():
+            keep=self.ui.keepPercent.value()/100.
+            if self.ui.huberCheck.isChecked():
+                huber=1.5
+        
+        self.reduce_outline()
+        
+        #candidates as (mirror plane, flip axis)
+        candidates=[(None,None),("x",None),("y",None)]
+        if self.ui.flipsCheck.isChecked():
+            candidates+=[(plane,axis) for plane in [None,"x","y"] for axis in ["x","y"]]
+        
+        M=[]
+        for plane,axis in candidates:
+            F=np.identity(4) #as applied by flip
+            if axis == "x":
+                F[1,1],F[2,2]=-1,-1
+            if axis == "y":
+                F[0,0],F[2,2]=-1,-1
+            M.append(np.dot(self.mirror_matrix(plane),F))
+        
+        n=len(candidates)
+        with ThreadPoolExecutor(max_workers=n) as ex:
+            results=list(ex.map(trial_alignment,[self.fO_local]*n,[self.rO_local]*n,M,[keep]*n,[huber]*n))
+        
+        best=int(np.argmin([r[0] for r in results]))
+        plane,axis=candidates[best]
+        residual,T=results[best]
+        
+        if plane is not None:
+            self.flipside(plane)
+        if axis is not None:
+            self.flip(axis)
+        
+        #apply operation
+        self.flp=apply_trans(self.flp,T)
+        self.fO_local=apply_trans(self.fO_local,T)
+        self.floatTrans.append(T)
+        
+        self.update_float()
+        self.update_limits()
+        self.ren.ResetCamera()
+        
+        desc=[]
+        if plane is not None: desc.append("mirror %s"%plane)
+        if axis is not None: desc.append("flip %s"%axis)
+        if not desc: desc.append("no mirror")
+        self.ui.statLabel.setText("Applied %s with alignment, mean residual %0.4f."%(" and ".join(desc),residual))
+    
     def accept_align(self):
         '''
         Accepts the current alignment and allows analysis to proceed if the profile has not been algorithmically aligned with the align button being pressed.
@@ -708,10 +934,15 @@ class aa_interactor(QtWidgets.QWidget):
 
         if self.ui.useICPalignButton.isChecked():
             self.reduce_outline()
-            T,_,_ = icp(self.fO_local,self.rO_local)
-            
-            
-            
+            T,_ = align_outlines(self.fO_local,self.rO_local)
+        
+        if self.ui.useTrimmedICPalignButton.isChecked():
+            self.reduce_outline()
+            if self.ui.huberCheck.isChecked():
+                huber=1.5 #multiple of the median retained distance
+            else: huber=None
+            T,_ = align_outlines(self.fO_local,self.rO_local,
+                keep=self.ui.keepPercent.value()/100.,huber=huber)
             
         #apply operation
         self.flp=apply_trans(self.flp,T)
@@ -742,6 +973,10 @@ class aa_interactor(QtWidgets.QWidget):
             
         if hasattr(self,'aActor'):
             self.ren.RemoveActor(self.aActor)
+        if hasattr(self,'dActor'):
+            self.ren.RemoveActor(self.dActor)
+            del self.dActor
+        self.ui.avgDisplay.setCurrentIndex(0)
         
         if filem == None:
             filem, _, =get_file('*.mat')
@@ -749,6 +984,8 @@ class aa_interactor(QtWidgets.QWidget):
         if filem: #check variables
             mat_contents = sio.loadmat(filem)
             self.fileo=filem
+            self.interp_cache=None
+            self.raster=None
             if 'aa' in mat_contents:
 
                 
@@ -764,12 +1001,11 @@ class aa_interactor(QtWidgets.QWidget):
                 
                 self.rp=self.rp[np.where(ind)]
                 
-                #apply the transform with post multiplication
+                #apply the composed transform with post multiplication
+                T=compose_trans(self.refTrans)
+                self.rp=apply_trans(self.rp,T,inplace=True)
+                self.rO=apply_trans(self.rO,T)
                 
-                for transformation in self.refTrans:
-                    self.rp=apply_trans(self.rp,transformation)
-                    self.rO=apply_trans(self.rO,transformation)
-                    
                 self.rO_local=self.rO
 
                 
@@ -796,9 +1032,9 @@ class aa_interactor(QtWidgets.QWidget):
                 self.floatTrans=mat_contents['trans']['float'][0][0]
                 #read in as np array
                 
-                for transformation in self.floatTrans:
-                    self.flp=apply_trans(self.flp,transformation)
-                    self.fO=apply_trans(self.fO,transformation)
+                T=compose_trans(self.floatTrans)
+                self.flp=apply_trans(self.flp,T,inplace=True)
+                self.fO=apply_trans(self.fO,T)
                 
                 
                 self.fO_local=self.fO
@@ -810,8 +1046,7 @@ class aa_interactor(QtWidgets.QWidget):
                 self.floatTrans = self.floatTrans.tolist()
                 
                 #show aligned and averaged data
-                self.ap=mat_contents['aa']['pnts'][0][0]
-                self.gsize=mat_contents['aa']['gsize'][0][0]
+                self.ap, self.gsize, self.raster = read_aa(mat_contents)
 
                 #do grid
                 self.ui.gridInd.setValue(self.gsize)
@@ -925,6 +1160,9 @@ class aa_interactor(QtWidgets.QWidget):
             if hasattr(self,'aActor'):
                 self.aActor.SetScale(s)
                 self.aActor.Modified()
+            if hasattr(self,'dActor'):
+                self.dActor.SetScale(s)
+                self.dActor.Modified()
             
             self.ren.RemoveActor(self.axisActor)
             self.axisActor = add_axis(self.ren,nl,axs)
@@ -943,6 +1181,9 @@ class aa_interactor(QtWidgets.QWidget):
             if hasattr(self,'aActor'):
                 self.aActor.SetScale(s)
                 self.aActor.Modified()
+            if hasattr(self,'dActor'):
+                self.dActor.SetScale(s)
+                self.dActor.Modified()
 
             self.ren.RemoveActor(self.axisActor)
             self.axisActor = add_axis(self.ren,nl,axs)
@@ -963,6 +1204,9 @@ class aa_interactor(QtWidgets.QWidget):
                 # self.fActor.SetScale(1,1,self.Zaspect)
                 self.aActor.SetScale(s)
                 self.aActor.Modified()
+            if hasattr(self,'dActor'):
+                self.dActor.SetScale(s)
+                self.dActor.Modified()
             self.ren.RemoveActor(self.axisActor)
             self.axisActor = add_axis(self.ren,self.limits,[1,1,1])
             self.ren.ResetCamera()
@@ -1013,12 +1257,192 @@ class aa_interactor(QtWidgets.QWidget):
         return s,nl,axs
 
 
-def apply_trans(P,T):
+def avg_grid(O,gsize):
+    '''
+    Returns x and y coordinates of a regular grid with a characteristic spacing of gsize between 1.1 times the minimum and maximum coordinates of outline O, which should have been shifted into the first quadrant (see average)
+    '''
+    OMin=np.amin(O,axis=0)
+    OMax=np.amax(O,axis=0)
+    gx=np.linspace(1.1*OMin[0],1.1*OMax[0],int((1.1*OMax[0]-1.1*OMin[0])/gsize))
+    gy=np.linspace(1.1*OMin[1],1.1*OMax[1],int((1.1*OMax[1]-1.1*OMin[1])/gsize))
+    return gx, gy
+
+class grid_accumulator(object):
+    '''
+    Streaming per-cell statistics of any number of gridded datasets of the same shape, keeping only the sum, sum of squares and count of each cell, such that memory use doesn't depend on the number of datasets
+    '''
+    def __init__(self,shape):
+        self.sum=np.zeros(shape)
+        self.sumsq=np.zeros(shape)
+        self.count=np.zeros(shape,dtype=int)
+    
+    def add(self,z):
+        '''
+        Accumulates gridded data z, where cells that are NaN are ignored
+        '''
+        valid=~np.isnan(z)
+        self.sum[valid]+=z[valid]
+        self.sumsq[valid]+=z[valid]**2
+        self.count+=valid
+    
+    def mean(self,min_count=1):
+        '''
+        Returns the mean of each cell, NaN where fewer than min_count datasets contributed
+        '''
+        with np.errstate(invalid='ignore',divide='ignore'):
+            m=self.sum/self.count
+        m[self.count<max(min_count,1)]=np.nan
+        return m
+    
+    def std(self,min_count=2):
+        '''
+        Returns the standard deviation of each cell, NaN where fewer than min_count datasets contributed
+        '''
+        m=self.mean(min_count)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            v=self.sumsq/self.count-m**2
+        return np.sqrt(np.clip(v,0,None))
+
+def read_scan(mat_contents,side='ref'):
+    '''
+    Returns the masked points and outline of the side ('ref' or 'float') contained in the contents of a *.mat file written by point_cloud, for use with average_scans
+    '''
+    pnts=mat_contents[side]['rawPnts'][0][0]
+    ind=mat_contents[side]['mask'][0][0][0]
+    return pnts[np.where(ind)], mat_contents[side]['x_out'][0][0]
+
+def average_scans(ref,scans,gsize=None,keep=1.0,huber=None,min_count=1):
     '''
-    Apply rotation/reflection and translation in homogeneous matrix T on a discrete basis to a Nx3 point cloud P
+    Registers any number of scans to a reference and averages them all onto a single raster. ref and each entry of scans are tuples of an Nx3 array of points and an outline, see read_scan. Each scan is posed with initial_pose, refined with align_outlines and then gridded and accumulated in turn, so only one triangulation is held in memory at a time. gsize defaults to the mean nearest neighbour spacing of the reference. Cells are averaged where at least min_count datasets contribute. Returns a dictionary of the raster (z, origin, spacing, mask, std and count) and a list of transformations for apply_trans applied to each scan.
     '''
+    rp,rO=ref
+    if gsize is None:
+        gsize=nn_spacing(rp[:,:2],sample=10000)
+    
+    #grid as per average, with the reference shifted into the first quadrant
+    tT=np.amin(rO,axis=0)
+    gx, gy = avg_grid(rO-tT,gsize)
+    gx, gy = gx+tT[0], gy+tT[1]
+    grid_x, grid_y = np.meshgrid(gx, gy, indexing='xy')
+    acc=grid_accumulator(grid_x.shape)
+    acc.add(LinearNDInterpolator(rp[:,:2],rp[:,-1])(grid_x,grid_y))
+    
+    trans=[]
+    for fp,fO in scans:
+        T0,_,_=initial_pose(fO,rO)
+        T0[0:3,0:3]=T0[0:3,0:3].T #icp form to apply_trans form
+        fO=apply_trans(fO,T0)
+        T1,_=align_outlines(fO,rO,keep=keep,huber=huber)
+        for T in (T0,T1):
+            fp=apply_trans(fp,T)
+        acc.add(LinearNDInterpolator(fp[:,:2],fp[:,-1])(grid_x,grid_y))
+        trans.append([T0,T1])
+    
+    z=acc.mean(min_count)
+    inOutline=poly_mask(rO,gx,gy)
+    mask=np.logical_and(inOutline,~np.isnan(z))
+    z[~mask]=np.nan
+    
+    raster={'z':z,
+        'origin':np.array([gx[0],gy[0]]),
+        'spacing':np.array([gx[1]-gx[0],gy[1]-gy[0]]),
+        'mask':mask,
+        'std':acc.std(max(min_count,2)),
+        'count':acc.count}
+    return raster, trans
+
+def outline_image(O,x):
+    '''
+    Returns a boolean image of the region enclosed by outline O on the square grid with cell centres x in both directions
+    '''
+    return poly_mask(O,x,x)
 
-    return np.dot(P,T[0:3,0:3])+T[0:3,-1]
+def pose_search(fO,Fr,x,angles):
+    '''
+    Correlates the image of outline fO rotated by each of angles (degrees) against the FFT of the reference image Fr on grid x. Returns the best score, angle and translation.
+    '''
+    n,h=len(x),x[1]-x[0]
+    best=(-np.inf,0,np.zeros(2))
+    for a in angles:
+        c,s=np.cos(np.deg2rad(a)),np.sin(np.deg2rad(a))
+        rot=np.dot(fO[:,:2],np.array([[c,s],[-s,c]]))
+        F=outline_image(rot,x).astype(float)
+        corr=np.real(np.fft.ifft2(Fr*np.conj(np.fft.fft2(F))))
+        ind=np.unravel_index(np.argmax(corr),corr.shape)
+        score=corr[ind]/max(F.sum(),1)
+        if score>best[0]:
+            #wrap circular shift to +/- half the grid
+            d=(np.array(ind[::-1])+n//2)%n-n//2
+            best=(score,a,d*h)
+    return best
+
+def initial_pose(fO,rO,mirror_axis=0,n=128,step=2.0):
+    '''
+    Global initial pose of outline fO relative to rO, for seeding icp. Both outlines are rasterized on a common grid of n x n cells, and for each rotation in step degrees, the translation is found by FFT-based cross correlation, followed by a finer search about the best rotation. Outlines are respaced to at most 200 points for rasterizing. The unmirrored and mirrored (negating mirror_axis) options are evaluated in parallel. Returns the 4x4 homogeneous transformation that maps fO on to rO (pre-multiplication, as per icp), whether it contains the mirror operation and the overlap score (1 is a perfect match).
+    '''
+    cf=np.mean(fO[:,:2],axis=0)
+    cr=np.mean(rO[:,:2],axis=0)
+    fO=respace_equally(np.vstack((fO[:,:2],fO[0,:2])),int(min(len(fO),200)))[0]
+    rO=respace_equally(np.vstack((rO[:,:2],rO[0,:2])),int(min(len(rO),200)))[0]
+    L=1.5*np.amax(np.hstack((np.linalg.norm(fO[:,:2]-cf,axis=1),np.linalg.norm(rO[:,:2]-cr,axis=1))))
+    x=np.linspace(-L,L,n)
+    Fr=np.fft.fft2(outline_image(rO[:,:2]-cr,x).astype(float))
+    
+    def search(mirrored):
+        local=fO[:,:2]-cf
+        if mirrored:
+            local=local.copy()
+            local[:,mirror_axis]=-local[:,mirror_axis]
+        score,a,d=pose_search(local,Fr,x,np.arange(-180,180,step))
+        score,a,d=pose_search(local,Fr,x,np.arange(a-step,a+step,step/8.))
+        return score,a,d
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results=list(executor.map(search,[False,True]))
+    mirrored=results[1][0]>results[0][0]
+    score,a,d=results[int(mirrored)]
+    
+    #assemble p' = R(M(p-cf)) + cr + d
+    M=np.identity(3)
+    if mirrored:
+        M[mirror_axis,mirror_axis]=-1
+    R=np.identity(3)
+    c,s=np.cos(np.deg2rad(a)),np.sin(np.deg2rad(a))
+    R[0:2,0:2]=np.array([[c,-s],[s,c]])
+    T=np.identity(4)
+    T[0:3,0:3]=np.dot(R,M)
+    T[0:2,3]=cr+d-np.dot(T[0:2,0:2],cf)
+    return T, mirrored, score
+
+def trial_alignment(fO,rO,M,keep=1.0,huber=None):
+    '''
+    Applies M to outline fO and aligns the result to rO with align_outlines, for use in a thread pool. Returns the mean residual and the alignment transformation matrix for apply_trans.
+    '''
+    T,residual=align_outlines(apply_trans(fO,M),rO,keep=keep,huber=huber)
+    return residual, T
+
+def align_outlines(fO,rO,keep=1.0,huber=None):
+    '''
+    Aligns outline fO to outline rO with the K-neighbour ICP, trimmed to the best keep fraction of correspondences and optionally Huber weighted - see icp in pyCMcommon. Outlines with a differing number of points are respaced to the smaller count. Returns the homogeneous transformation matrix for apply_trans and the mean distance of retained correspondences after alignment.
+    '''
+    
+    n=int(min(len(fO),len(rO)))
+    A=np.zeros((n,3))
+    B=np.zeros((n,3))
+    if len(fO)==len(rO):
+        A[:,:2],B[:,:2]=fO[:,:2],rO[:,:2]
+    else:
+        A[:,:2]=respace_equally(fO[:,:2],n)[0]
+        B[:,:2]=respace_equally(rO[:,:2],n)[0]
+    
+    T,_,_ = icp(A,B,keep=keep,huber=huber)
+    
+    #icp returns T for pre-multiplication, apply_trans post-multiplies
+    T[0:3,0:3]=T[0:3,0:3].T
+    
+    d,_=nearest_neighbor(apply_trans(A,T),B)
+    nkeep=max(1,int(round(keep*n)))
+    return T, np.mean(np.sort(d)[:nkeep])
 
 
 if __name__ == '__main__':
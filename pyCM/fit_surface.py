@@ -29,17 +29,20 @@ __email__ = "matthew.roy@manchester.ac.uk"
 __status__ = "Experimental"
 
 import os,sys,time
+from concurrent.futures import ProcessPoolExecutor
 import vtk
+import vtk.util.numpy_support as v2n
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from PyQt5 import QtCore, QtGui, QtWidgets
 import numpy as np
 import scipy.io as sio
-from scipy.interpolate import griddata,bisplrep,bisplev
+from scipy.interpolate import griddata
 from scipy.spatial.distance import pdist, squareform
-from scipy.spatial import Delaunay
-from matplotlib import path
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from pkg_resources import Requirement, resource_filename
 from pyCM.pyCMcommon import *
+from pyCM.spline import bisplev_points, spline_knots, spline_normal_eq, fit_spline_sparse, fit_spline_robust, clear_cache, surface_model, bspline_model, read_fit_model
 
 
 def sf_def(*args, **kwargs):
@@ -114,8 +117,25 @@ class sf_main_window(object):
         self.undoLastPickButton=QtWidgets.QPushButton('Undo last pick')
         self.reloadButton = QtWidgets.QPushButton('Undo all/reload')
 
-        splineLabel=QtWidgets.QLabel("Bivariate spline fitting")
+        splineLabel=QtWidgets.QLabel("Surface fitting")
         splineLabel.setFont(QtGui.QFont("Helvetica [Cronyx]",weight=QtGui.QFont.Bold))
+        modelLabel=QtWidgets.QLabel("Fit model")
+        self.fitModel = QtWidgets.QComboBox()
+        self.fitModel.addItems(['B-spline','Legendre','Chebyshev','Fourier'])
+        self.fitModel.setToolTip('Bivariate spline, or a global 2D polynomial/Fourier series')
+        
+        self.degLabel=QtWidgets.QLabel("Degree/harmonics")
+        self.degEdit_x = QtWidgets.QSpinBox()
+        self.degEdit_x.setMinimum(0)
+        self.degEdit_x.setMaximum(30)
+        self.degEdit_x.setValue(6)
+        self.degEdit_x.setPrefix('x: ')
+        self.degEdit_y = QtWidgets.QSpinBox()
+        self.degEdit_y.setMinimum(0)
+        self.degEdit_y.setMaximum(30)
+        self.degEdit_y.setValue(6)
+        self.degEdit_y.setPrefix('y: ')
+        
         self.numLabel1=QtWidgets.QLabel("Knot spacing (x)")
         self.numEdit1 = QtWidgets.QDoubleSpinBox()
         self.numEdit1.setMaximum(10000)
@@ -160,7 +180,23 @@ class sf_main_window(object):
         self.dry.setDecimals(3)
         dry_label=QtWidgets.QLabel("y")
         
+        robustLabel=QtWidgets.QLabel("Robust fitting")
+        self.robustMode = QtWidgets.QComboBox()
+        self.robustMode.addItems(['Off','Huber','Tukey'])
+        self.robustMode.setToolTip('Iteratively reweight points to reject outliers, which are flagged for removal')
+        
         self.updateButton = QtWidgets.QPushButton('Fit')
+        self.showResiduals = QtWidgets.QCheckBox('Show residuals')
+        self.showResiduals.setToolTip('Colour points by their residual from the fit')
+        self.tileEdit = QtWidgets.QDoubleSpinBox()
+        self.tileEdit.setMaximum(10000)
+        self.tileEdit.setMinimum(0.001)
+        self.tileEdit.setDecimals(3)
+        self.tileEdit.setValue(5)
+        self.tileEdit.setPrefix('Tile: ')
+        self.tileEdit.setToolTip('Tile size for residual statistics written with the fit')
+        self.sweepButton = QtWidgets.QPushButton('Sweep')
+        self.sweepButton.setToolTip('Cross-validate knot spacings and orders around the current values and apply the best')
 
         #statLabel is what the ui is doing, not to be confused with statLabel
         self.statLabel=QtWidgets.QLabel("Idle")
@@ -210,16 +246,28 @@ class sf_main_window(object):
         mainUiBox.addWidget(horizLine2,5,0,1,2)
 
         mainUiBox.addWidget(splineLabel,6,0,1,2)
-        mainUiBox.addWidget(self.numLabel1,7,0,1,1)
-        mainUiBox.addWidget(self.numEdit1,7,1,1,1)
-        mainUiBox.addWidget(self.numLabel2,8,0,1,1)
-        mainUiBox.addWidget(self.numEdit2,8,1,1,1)
-        mainUiBox.addWidget(self.numLabel3,9,0,1,1)
-        mainUiBox.addWidget(self.numEdit3,9,1,1,1)
-        mainUiBox.addWidget(self.numLabel4,10,0,1,1)
-        mainUiBox.addWidget(self.numEdit4,10,1,1,1)
-        mainUiBox.addWidget(self.updateButton,12,0,1,2)
-        mainUiBox.addWidget(numLabel6,13,0,1,2)
+        mainUiBox.addWidget(modelLabel,7,0,1,1)
+        mainUiBox.addWidget(self.fitModel,7,1,1,1)
+        degLayout = QtWidgets.QHBoxLayout()
+        degLayout.addWidget(self.degEdit_x)
+        degLayout.addWidget(self.degEdit_y)
+        mainUiBox.addWidget(self.degLabel,8,0,1,1)
+        mainUiBox.addLayout(degLayout,8,1,1,1)
+        mainUiBox.addWidget(self.numLabel1,9,0,1,1)
+        mainUiBox.addWidget(self.numEdit1,9,1,1,1)
+        mainUiBox.addWidget(self.numLabel2,10,0,1,1)
+        mainUiBox.addWidget(self.numEdit2,10,1,1,1)
+        mainUiBox.addWidget(self.numLabel3,11,0,1,1)
+        mainUiBox.addWidget(self.numEdit3,11,1,1,1)
+        mainUiBox.addWidget(self.numLabel4,12,0,1,1)
+        mainUiBox.addWidget(self.numEdit4,12,1,1,1)
+        mainUiBox.addWidget(robustLabel,13,0,1,1)
+        mainUiBox.addWidget(self.robustMode,13,1,1,1)
+        mainUiBox.addWidget(self.updateButton,14,0,1,1)
+        mainUiBox.addWidget(self.sweepButton,14,1,1,1)
+        mainUiBox.addWidget(self.showResiduals,15,0,1,1)
+        mainUiBox.addWidget(self.tileEdit,15,1,1,1)
+        mainUiBox.addWidget(numLabel6,16,0,1,2)
         
         displayLayout = QtWidgets.QGridLayout()
         displayLayout.addWidget(drx_label,0,0)
@@ -227,12 +275,12 @@ class sf_main_window(object):
         displayLayout.addWidget(dry_label,0,2)
         displayLayout.addWidget(self.dry,0,3)
         
-        mainUiBox.addLayout(displayLayout,14,0,1,2)
-        mainUiBox.addWidget(horizLine2,15,0,1,2)
-        mainUiBox.addLayout(sectionBox,16,0,5,2)
-        mainUiBox.addWidget(horizLine3,21,0,1,2)
-        mainUiBox.addWidget(self.writeButton,22,0,1,2)
-        mainUiBox.addWidget(horizLine4,23,0,1,2)
+        mainUiBox.addLayout(displayLayout,17,0,1,2)
+        mainUiBox.addWidget(horizLine2,18,0,1,2)
+        mainUiBox.addLayout(sectionBox,19,0,5,2)
+        mainUiBox.addWidget(horizLine3,24,0,1,2)
+        mainUiBox.addWidget(self.writeButton,25,0,1,2)
+        mainUiBox.addWidget(horizLine4,26,0,1,2)
 
         
         sectionBox.addWidget(sectionLabel,0,0,1,4)
@@ -284,6 +332,7 @@ class surf_int(QtWidgets.QWidget):
         self.fitted=False
 
         self.ui.updateButton.clicked.connect(lambda: self.onUpdateSpline())
+        self.ui.sweepButton.clicked.connect(lambda: self.sweep())
         self.ui.sectionButton.clicked.connect(lambda: self.Cut())
         self.ui.revertButton.clicked.connect(lambda: self.RemoveCut())
         self.ui.writeButton.clicked.connect(lambda: self.write())
@@ -293,11 +342,28 @@ class surf_int(QtWidgets.QWidget):
         self.ui.numEdit2.valueChanged.connect(self.changeUpdateBackground)
         self.ui.numEdit3.valueChanged.connect(self.changeUpdateBackground)
         self.ui.numEdit4.valueChanged.connect(self.changeUpdateBackground)
-        self.ui.drx.valueChanged.connect(self.changeUpdateBackground)
-        self.ui.dry.valueChanged.connect(self.changeUpdateBackground)
+        self.ui.robustMode.currentIndexChanged.connect(self.changeUpdateBackground)
+        self.ui.fitModel.currentIndexChanged.connect(self.set_fit_model)
+        self.ui.degEdit_x.valueChanged.connect(self.changeUpdateBackground)
+        self.ui.degEdit_y.valueChanged.connect(self.changeUpdateBackground)
+        self.ui.showResiduals.stateChanged.connect(self.display_residuals)
+        self.ui.drx.valueChanged.connect(self.update_display_res)
+        self.ui.dry.valueChanged.connect(self.update_display_res)
+        self.set_fit_model()
         
     def changeUpdateBackground(self):
         self.ui.updateButton.setStyleSheet("background-color : None")
+    
+    def set_fit_model(self):
+        '''
+        Enables the inputs relevant to the selected fit model
+        '''
+        spline=self.ui.fitModel.currentText()=='B-spline'
+        for widget in (self.ui.numEdit1,self.ui.numEdit2,self.ui.numEdit3,self.ui.numEdit4,self.ui.robustMode,self.ui.sweepButton):
+            widget.setEnabled(spline)
+        for widget in (self.ui.degEdit_x,self.ui.degEdit_y):
+            widget.setEnabled(not spline)
+        self.changeUpdateBackground()
 
     def get_input_data(self,filem):
         """
@@ -310,7 +376,11 @@ class surf_int(QtWidgets.QWidget):
         
         if hasattr(self,'splineActor'):
             self.ren.RemoveActor(self.splineActor)
-
+        
+        for attr in ('fit_state','model','residual','crop','clipPlanes'):
+            if hasattr(self,attr):
+                delattr(self,attr)
+        clear_cache() #release basis evaluations of the last points
         
         if filem == None:
             filem, _, =get_file('*.mat')
@@ -320,14 +390,11 @@ class surf_int(QtWidgets.QWidget):
             self.fileo=filem
             
             try:
-                pts=mat_contents['aa']['pnts'][0][0]
+                self.pts, _, self.raster = read_aa(mat_contents)
                 refTrans=mat_contents['trans']['ref'][0][0]
                 
-
-                self.pts=pts[~np.isnan(pts).any(axis=1)] #remove all nans
                 self.RefOutline=np.concatenate(mat_contents['ref']['x_out'],axis=0)[0]
-                for transformation in refTrans:
-                    self.RefOutline = np.dot(self.RefOutline,transformation[0:3,0:3])+transformation[0:3,-1]
+                self.RefOutline = apply_trans(self.RefOutline,compose_trans(refTrans))
                 
                 self.RefMin=np.amin(self.RefOutline,axis=0)
                 self.RefMax=np.amax(self.RefOutline,axis=0)
@@ -338,6 +405,7 @@ class surf_int(QtWidgets.QWidget):
                 self.ui.yMax.setText('%.3f'%self.limits[3])
                 
                 self.bool_pnt=np.ones(len(self.pts), dtype=bool) #initialize mask
+                self.cropped=np.zeros(len(self.pts), dtype=bool) #points removed by sectioning
                 
                 #Generate actors
                 color=(int(0.2784*255),int(0.6745*255),int(0.6941*255))
@@ -353,32 +421,30 @@ class surf_int(QtWidgets.QWidget):
                 #add axes
                 self.axisActor = add_axis(self.ren,self.limits,[1,1,1])
                 
-                if 'spline_x' in mat_contents: #then it can be displayed & settings displayed
-                    bsplinerep=mat_contents['spline_x']['tck'][0][0]
-                    #recast tck as a tuple
-                    self.tck=tuple()
-                    for j in range(5):
-                        self.tck=self.tck+tuple(bsplinerep[0,j])
-                    spacing=mat_contents['spline_x']['kspacing'][0][0][0]
-                    order=mat_contents['spline_x']['order'][0][0][0]
-                    # smoothing=mat_contents['spline_x']['smooth'][0][0]
-                    self.gx,self.gy=spacing[0],spacing[1]
-                    self.ui.numEdit1.setValue(self.gx)
-                    self.ui.numEdit2.setValue(self.gy)
-                    self.ui.numEdit3.setValue(int(order[0]))
-                    self.ui.numEdit4.setValue(int(order[1]))
-                    self.bool_pnt=mat_contents['aa_mask'][0]
+                model=read_fit_model(mat_contents)
+                if model is not None: #then it can be displayed & settings displayed
+                    self.model=model
+                    if 'spline_x' in mat_contents:
+                        spacing=mat_contents['spline_x']['kspacing'][0][0][0]
+                        order=mat_contents['spline_x']['order'][0][0][0]
+                        # smoothing=mat_contents['spline_x']['smooth'][0][0]
+                        self.gx,self.gy=spacing[0],spacing[1]
+                        self.ui.numEdit1.setValue(self.gx)
+                        self.ui.numEdit2.setValue(self.gy)
+                        self.ui.numEdit3.setValue(int(order[0]))
+                        self.ui.numEdit4.setValue(int(order[1]))
+                        self.ui.fitModel.setCurrentIndex(0)
+                    else:
+                        self.gx,self.gy=self.ui.numEdit1.value(),self.ui.numEdit2.value()
+                        self.ui.degEdit_x.setValue(model.nx)
+                        self.ui.degEdit_y.setValue(model.ny)
+                        self.ui.fitModel.setCurrentText(model.form)
+                    #mask may be absent or stale if the data has been averaged again since
+                    if 'aa_mask' in mat_contents and mat_contents['aa_mask'].size==len(self.pts):
+                        self.bool_pnt=mat_contents['aa_mask'].ravel().astype(bool)
 
                     #find points to be painted red
-                    localind=np.asarray(range(len(self.bool_pnt)))
-                    localind=localind[np.where(np.logical_not(self.bool_pnt))]
-                    
-                    for i in localind:
-                        #turn them red
-                        self.colors.SetTuple(i,(255,0,0))
-
-                    self.vtkPntsPolyData.GetPointData().SetScalars(self.colors)
-                    self.vtkPntsPolyData.Modified()
+                    self.paint_points(np.where(np.logical_not(self.bool_pnt))[0],(255,0,0))
                     
                     
                     self.DisplayFit()
@@ -403,7 +469,8 @@ class surf_int(QtWidgets.QWidget):
         self.ui.vtkWidget.setFocus()
             
     def onUpdateSpline(self):
-        p,ro,rmin,rmax=self.pts[np.where(self.bool_pnt)],self.RefOutline,self.RefMin,self.RefMax
+        p,ro=self.pts[np.where(self.bool_pnt)],self.RefOutline
+        rmin,rmax=self.fit_region()
         self.ui.statLabel.setText("Fitting . . .")
         QtWidgets.qApp.processEvents()
         #read input parameters
@@ -411,29 +478,91 @@ class surf_int(QtWidgets.QWidget):
         self.gy=self.ui.numEdit2.value()
         kx=self.ui.numEdit3.value()
         ky=self.ui.numEdit4.value()
-
-        tx=np.linspace(rmin[0],rmax[0],int((rmax[0]-rmin[0])/self.gx))
-        ty=np.linspace(rmin[1],rmax[1],int((rmax[1]-rmin[1])/self.gy))
+        
+        if hasattr(self,'fit_state'):
+            del self.fit_state
+        
+        form=self.ui.fitModel.currentText()
+        if form!='B-spline': #global basis fit
+            try:
+                self.model=surface_model(form,self.ui.degEdit_x.value(),self.ui.degEdit_y.value(),[rmin[0],rmax[0],rmin[1],rmax[1]]).fit(p)
+            except (ValueError,np.linalg.LinAlgError) as ve:
+                self.ui.statLabel.setText("Last fit failed: %s"%ve)
+                return
+            self.DisplayFit()
+            return
 
         #make sure both x & y have enough values in either direction
-        if len(tx)<3 or len(ty)<3:
+        knots=spline_knots(rmin,rmax,self.gx,self.gy,kx,ky)
+        if knots is None:
             self.ui.statLabel.setText("Grid too large . . .")
             self.ui.updateButton.setEnabled(True)
             return
-        tx=np.insert(tx,0,[rmin[0]] * kx) #to make sure knots are repeated at edges
-        tx=np.insert(tx,-1,[rmax[0]] * kx)
-        ty=np.insert(ty,0,[rmin[1]] * ky) #to make sure knots are repeated at edges
-        ty=np.insert(ty,-1,[rmax[1]] * ky)
         
-
+        method=self.ui.robustMode.currentText().lower()
         try:
-            self.tck = bisplrep(p[:,0], p[:,1], p[:,2], kx=kx, ky=ky, tx=tx, ty=ty, task=-1) #get spline representation
+            if method=='off':
+                #keep the normal equations for incremental refitting after picks
+                self.fit_state = spline_normal_eq(self.pts,knots[0],knots[1],kx,ky,self.bool_pnt)
+                tck = self.fit_state.solve()
+            else:
+                tck, _, outliers = fit_spline_robust(p,knots[0],knots[1],kx,ky,method=method)
         except ValueError as ve:
-            self.ui.statLabel.setText("Last fit failed.")
+            self.ui.statLabel.setText("Last fit failed: %s"%ve)
             return
+        self.model=bspline_model(tck)
         
         self.DisplayFit()
+        
+        if method!='off' and np.any(outliers):
+            #flag outliers as a pick so that they can be reviewed and reverted with undo
+            ids=np.where(self.bool_pnt)[0][outliers]
+            self.lastSelectedIds=ids
+            self.bool_pnt[ids]=False
+            self.paint_points(ids,(255,0,0))
+            self.unsaved_changes=True
+            self.ui.statLabel.setText(self.ui.statLabel.text()+" Flagged %d outliers, use undo last pick to restore them."%len(ids))
             
+    def sweep(self):
+        '''
+        Scores combinations of knot spacing and order about the current values by k-fold cross validation in a process pool, shows the results and fits with the recommended values
+        '''
+        if not hasattr(self,'pts'):
+            return
+        self.ui.statLabel.setText("Cross validating, this may take some time . . .")
+        QtWidgets.qApp.processEvents()
+        
+        p=self.pts[np.where(self.bool_pnt)]
+        factors=np.array([0.5,0.75,1,1.5,2])
+        gxs=self.ui.numEdit1.value()*factors
+        gys=self.ui.numEdit2.value()*factors
+        kxs=list(range(max(1,self.ui.numEdit3.value()-1),min(5,self.ui.numEdit3.value()+1)+1))
+        kys=list(range(max(1,self.ui.numEdit4.value()-1),min(5,self.ui.numEdit4.value()+1)+1))
+        
+        rmin,rmax=self.fit_region()
+        rmse=spline_sweep(p,rmin,rmax,gxs,gys,kxs,kys)
+        if np.all(np.isnan(rmse)):
+            self.ui.statLabel.setText("Sweep failed, no combination could be fitted.")
+            return
+        i,j,k,l=np.unravel_index(np.nanargmin(rmse),rmse.shape)
+        
+        self.ui.numEdit1.setValue(gxs[i])
+        self.ui.numEdit2.setValue(gys[j])
+        self.ui.numEdit3.setValue(kxs[k])
+        self.ui.numEdit4.setValue(kys[l])
+        
+        self.sweep_dialog=plot_sweep(rmse,gxs,gys,kxs,kys,parent=self)
+        self.onUpdateSpline()
+        self.ui.statLabel.setText("Recommended knot spacing %0.3f, %0.3f and order %d, %d with a cross validated RMSE of %2.2f micron."%(gxs[i],gys[j],kxs[k],kys[l],rmse[i,j,k,l]*1000))
+    
+    def fit_region(self):
+        '''
+        Returns the minimum and maximum x, y of the outline, limited to the section if the data has been cropped
+        '''
+        if not hasattr(self,'crop'):
+            return self.RefMin[:2],self.RefMax[:2]
+        return np.maximum(self.RefMin[:2],self.crop[[0,2]]),np.minimum(self.RefMax[:2],self.crop[[1,3]])
+    
     def DisplayFit(self):
 
         try:
@@ -441,65 +570,18 @@ class surf_int(QtWidgets.QWidget):
             if not hasattr(self,'dryval'): #then it won't have drxval
                 rx=np.linspace(self.RefMin[0],self.RefMax[0],int((self.RefMax[0]-self.RefMin[0])/(self.gx/4)))
                 ry=np.linspace(self.RefMin[1],self.RefMax[1],int((self.RefMax[1]-self.RefMin[1])/(self.gy/4)))
-                self.drxval,self.dryval=rx[1]-rx[0],ry[1]-ry[0]
-                self.ui.drx.setValue(self.drxval)
-                self.ui.dry.setValue(self.dryval)
             else: #read the res directly from UI, apply and update
-                self.drxval,self.dryval=self.ui.drx.value(),self.ui.dry.value()
-                rx=np.linspace(self.RefMin[0],self.RefMax[0],int((self.RefMax[0]-self.RefMin[0])/(self.drxval)))
-                ry=np.linspace(self.RefMin[1],self.RefMax[1],int((self.RefMax[1]-self.RefMin[1])/(self.dryval)))
-                self.drxval,self.dryval=rx[1]-rx[0],ry[1]-ry[0]
-                self.ui.drx.setValue(self.drxval)
-                self.ui.dry.setValue(self.dryval)
-                
-            grid_x, grid_y = np.meshgrid(rx,ry,indexing='xy')
-            grid_x=np.transpose(grid_x)
-            grid_y=np.transpose(grid_y)
-
-            points2D=np.vstack([grid_x.flatten(),grid_y.flatten()]).T
-            tri=Delaunay(points2D)
-            tri= tri.simplices
-            
-            znew = bisplev(grid_x[:,0], grid_y[0,:], self.tck)
-
-            points3D=np.vstack([points2D[:,0],points2D[:,1],znew.flatten()]).T
-            
-            #crop according to what's in the outline
-            #temporarily move the outline to the first quadrant
-            t_offset=np.array([0.1*self.RefMin[0],0.1*self.RefMin[1]])
-            
-            for j in range(0,2):
-                if t_offset[j]<0:
-                    points3D[:,j]=points3D[:,j]-t_offset[j]
-                    self.RefOutline[:,j]=self.RefOutline[:,j]-t_offset[j]
-
-
-            pth=path.Path(self.RefOutline[:,:2])
-            inOutline=pth.contains_points(points3D[:,:2])
-
-            ind=np.array(range(0,len(inOutline)))
-            ind_out=ind[np.invert(inOutline)]
-            
-            #remove all triangles that contain points outside the perimeter
-            tri = tri[(np.isin(tri,ind_out)==(0,0,0)).all(axis=1),:]
-
-            #move things back
-            for j in range(0,2):
-                if t_offset[j]<0:
-                    points3D[:,j]=points3D[:,j]+t_offset[j]
-                    self.RefOutline[:,j]=self.RefOutline[:,j]+t_offset[j]
+                rx,ry=self.get_display_grid()
+            self.set_display_res(rx,ry)
 
             self.ui.statLabel.setText("Rendering . . .")
-            self.DisplaySplineFit(points3D,tri)
+            self.DisplaySplineFit(rx,ry)
 
-            zeval = np.empty(np.size(self.pts[:,2]))
-            for i in range(len(zeval)):
-                zeval[i] = bisplev(self.pts[i,0], self.pts[i,1], self.tck)
+            zeval = self.model.eval_points(self.pts[:,0], self.pts[:,1])
 
-            a=(zeval-self.pts[:,2])
-            RSME=(np.sum(a*a)/len(a))**0.5
-
-            self.ui.statLabel.setText("RSME: %2.2f micron."%(RSME*1000))
+            self.residual=zeval-self.pts[:,2]
+            self.show_fit_stats()
+            self.display_residuals()
             
         except Exception as e:
             print(str(e))
@@ -508,34 +590,70 @@ class surf_int(QtWidgets.QWidget):
         self.ui.updateButton.setEnabled(True)
         self.ui.updateButton.setStyleSheet("background-color :rgb(77, 209, 97);")
 
-        
-    def DisplaySplineFit(self,p,t):
-
+    def get_display_grid(self):
+        '''
+        Returns x and y coordinates of the display grid according to the display resolution in the UI
+        '''
+        self.drxval,self.dryval=self.ui.drx.value(),self.ui.dry.value()
+        rx=np.linspace(self.RefMin[0],self.RefMax[0],int((self.RefMax[0]-self.RefMin[0])/(self.drxval)))
+        ry=np.linspace(self.RefMin[1],self.RefMax[1],int((self.RefMax[1]-self.RefMin[1])/(self.dryval)))
+        return rx,ry
+    
+    def set_display_res(self,rx,ry):
+        '''
+        Updates the display resolution in the UI to the actual spacing of the display grid without triggering a redraw
+        '''
+        self.drxval,self.dryval=rx[1]-rx[0],ry[1]-ry[0]
+        for widget,value in ((self.ui.drx,self.drxval),(self.ui.dry,self.dryval)):
+            widget.blockSignals(True)
+            widget.setValue(value)
+            widget.blockSignals(False)
+    
+    def update_display_res(self):
+        '''
+        Redraws the fit when the display resolution changes
+        '''
+        if not hasattr(self,'model') or not hasattr(self,'dryval'):
+            return
+        rx,ry=self.get_display_grid()
+        if len(rx)<2 or len(ry)<2:
+            return
+        self.DisplaySplineFit(rx,ry)
+    
+    def DisplaySplineFit(self,rx,ry):
+        '''
+        Shows the fitted surface evaluated on the grid rx, ry as a structured grid, with cells that aren't entirely within the outline hidden
+        '''
         if hasattr(self,'splineActor'):
             self.ren.RemoveActor(self.splineActor)
+        
+        grid_x, grid_y = np.meshgrid(rx,ry,indexing='xy')
+        znew = self.model.eval_grid(rx, ry).T #rows in y to match the grid
+        
+        #structured points are ordered with x varying fastest
         self.SplinePoints = vtk.vtkPoints()
-        triangles = vtk.vtkCellArray()
+        self.SplinePoints.SetData(v2n.numpy_to_vtk(np.column_stack((grid_x.ravel(),grid_y.ravel(),znew.ravel())),deep=1))
+        sGrid = vtk.vtkStructuredGrid()
+        sGrid.SetDimensions(len(rx),len(ry),1)
+        sGrid.SetPoints(self.SplinePoints)
         
-        #load up points
-        for i in p:
-            self.SplinePoints.InsertNextPoint(i)
-
-        for i in t:
-            triangle=vtk.vtkTriangle()
-            for j in range(0,3):
-                triangle.GetPointIds().SetId(j,i[j])
-            triangles.InsertNextCell(triangle)
-
-        trianglePolyData = vtk.vtkPolyData()
-        trianglePolyData.SetPoints(self.SplinePoints)
-        trianglePolyData.SetPolys(triangles)
-        #filter so that edges are shared
-        self.cSplinePolyData = vtk.vtkCleanPolyData()
-        self.cSplinePolyData.SetInputData(trianglePolyData)
+        #hide cells with any corner outside the outline
+        m=poly_mask(self.RefOutline,rx,ry)
+        inside=m[:-1,:-1] & m[1:,:-1] & m[:-1,1:] & m[1:,1:]
+        ghost=np.where(inside,0,vtk.vtkDataSetAttributes.HIDDENCELL).astype(np.uint8)
+        ghostArray=v2n.numpy_to_vtk(ghost.ravel(),deep=1)
+        ghostArray.SetName(vtk.vtkDataSetAttributes.GhostArrayName())
+        sGrid.GetCellData().AddArray(ghostArray)
+        
+        self.cSplinePolyData = vtk.vtkStructuredGridGeometryFilter()
+        self.cSplinePolyData.SetInputData(sGrid)
 
         # Create a mapper and actor for smoothed dataset
         self.Smapper = vtk.vtkPolyDataMapper()
         self.Smapper.SetInputConnection(self.cSplinePolyData.GetOutputPort())
+        self.Smapper.ScalarVisibilityOff()
+        if hasattr(self,'clipPlanes'): #only show the fit over the section
+            self.Smapper.SetClippingPlanes(self.clipPlanes)
 
         self.splineActor = vtk.vtkActor()
         self.splineActor.SetMapper(self.Smapper)
@@ -551,6 +669,14 @@ class surf_int(QtWidgets.QWidget):
 
     def Cut(self):
         pts=np.array([float(self.ui.xMin.text()),float(self.ui.xMax.text()),float(self.ui.yMin.text()),float(self.ui.yMax.text())])
+        
+        #crop the data to the section, restoring any previous section first; points already removed stay removed
+        self.bool_pnt[self.cropped]=True
+        inside=(self.pts[:,0]>=pts[0]) & (self.pts[:,0]<=pts[1]) & (self.pts[:,1]>=pts[2]) & (self.pts[:,1]<=pts[3])
+        self.cropped=self.bool_pnt & ~inside
+        self.bool_pnt[self.cropped]=False
+        self.crop=pts
+        self.invalidate_fit()
 
         planex1 = vtk.vtkPlane()
         planex1.SetOrigin(pts[0],0,0)
@@ -573,6 +699,7 @@ class surf_int(QtWidgets.QWidget):
         planeCollection.AddItem(planex2)
         planeCollection.AddItem(planey1)
         planeCollection.AddItem(planey2)
+        self.clipPlanes=planeCollection #applied to any subsequently drawn fit
         
         Omapper=self.outlineActor.GetMapper()
         Pmapper=self.pointActor.GetMapper()
@@ -581,6 +708,8 @@ class surf_int(QtWidgets.QWidget):
 
         if hasattr(self,'Smapper'):
             self.Smapper.SetClippingPlanes(planeCollection)
+        if hasattr(self,'residualActor'):
+            self.residualActor.GetMapper().SetClippingPlanes(planeCollection)
         nl=np.array(self.axisActor.GetBounds())
         self.ren.RemoveActor(self.axisActor)
         #add axes
@@ -593,6 +722,12 @@ class surf_int(QtWidgets.QWidget):
         self.ui.vtkWidget.setFocus()
     
     def RemoveCut(self):
+        self.bool_pnt[self.cropped]=True
+        self.cropped[:]=False
+        for attr in ('crop','clipPlanes'):
+            if hasattr(self,attr):
+                delattr(self,attr)
+        self.invalidate_fit()
         self.ui.xMin.setText('%.3f'%self.limits[0])
         self.ui.xMax.setText('%.3f'%self.limits[1])
         self.ui.yMin.setText('%.3f'%self.limits[2])
@@ -603,6 +738,8 @@ class surf_int(QtWidgets.QWidget):
         Pmapper.RemoveAllClippingPlanes()
         if hasattr(self,'Smapper'):
             self.Smapper.RemoveAllClippingPlanes()
+        if hasattr(self,'residualActor'):
+            self.residualActor.GetMapper().RemoveAllClippingPlanes()
         self.ren.RemoveActor(self.axisActor)
         #add axes
         self.axisActor = add_axis(self.ren,self.limits,[1,1,1])
@@ -633,6 +770,9 @@ class surf_int(QtWidgets.QWidget):
             if hasattr(self,'pointActor'):
                 self.pointActor.SetScale(s)
                 self.pointActor.Modified()
+            if hasattr(self,'residualActor'):
+                self.residualActor.SetScale(s)
+                self.residualActor.Modified()
             self.ren.RemoveActor(self.axisActor)
             self.axisActor = add_axis(self.ren,nl,axs)
 
@@ -645,6 +785,9 @@ class surf_int(QtWidgets.QWidget):
             if hasattr(self,'pointActor'):
                 self.pointActor.SetScale(s)
                 self.pointActor.Modified()
+            if hasattr(self,'residualActor'):
+                self.residualActor.SetScale(s)
+                self.residualActor.Modified()
             self.ren.RemoveActor(self.axisActor)
             self.axisActor = add_axis(self.ren,nl,axs)
 
@@ -657,6 +800,9 @@ class surf_int(QtWidgets.QWidget):
             if hasattr(self,'pointActor'):
                 self.pointActor.SetScale(s)
                 self.pointActor.Modified()
+            if hasattr(self,'residualActor'):
+                self.residualActor.SetScale(s)
+                self.residualActor.Modified()
 
             self.ren.RemoveActor(self.axisActor)
             self.axisActor = add_axis(self.ren,self.limits,[1,1,1])
@@ -771,15 +917,12 @@ class surf_int(QtWidgets.QWidget):
 
         
         if ids:
-            #store them in an array for an undo operation
-            self.lastSelectedIds=ids
-            for i in range(ids.GetNumberOfTuples()):
-                #turn them red
-                self.colors.SetTuple(ids.GetValue(i),(255,0,0))
-                self.bool_pnt[ids.GetValue(i)]=False
-        
-            self.vtkPntsPolyData.GetPointData().SetScalars(self.colors)
-            self.vtkPntsPolyData.Modified()
+            #store them in an array for an undo operation, cropped points are hidden so can't be picked
+            ids=v2n.vtk_to_numpy(ids)
+            self.lastSelectedIds=ids[~self.cropped[ids]]
+            self.bool_pnt[self.lastSelectedIds]=False
+            self.paint_points(self.lastSelectedIds,(255,0,0))
+            self.refit(self.lastSelectedIds,False)
         
         
         self.ui.vtkWidget.update()
@@ -788,20 +931,96 @@ class surf_int(QtWidgets.QWidget):
 
     def undo_pick(self):
         if hasattr(self,"lastSelectedIds"):
-            for i in range(self.lastSelectedIds.GetNumberOfTuples()):
-                #turn them from red to starting color
-                self.colors.SetTuple(self.lastSelectedIds.GetValue(i),(70, 171, 176))
-                self.bool_pnt[self.lastSelectedIds.GetValue(i)]=True
-            self.vtkPntsPolyData.GetPointData().SetScalars(self.colors)
-            self.vtkPntsPolyData.Modified()
-            self.ui.vtkWidget.update()
+            #turn them from red to starting color, unless they have since been cropped
+            self.lastSelectedIds=self.lastSelectedIds[~self.cropped[self.lastSelectedIds]]
+            self.bool_pnt[self.lastSelectedIds]=True
+            self.paint_points(self.lastSelectedIds,(70, 171, 176))
+            self.refit(self.lastSelectedIds,True)
         else:
             self.ui.statLabel.setText("No picked selection to revert.")
             
+    def refit(self,ids,add):
+        '''
+        Updates the current fit for points with indices ids being restored (add) or removed, by updating the stored normal equations rather than refitting from scratch
+        '''
+        if not hasattr(self,'fit_state'):
+            return
+        self.fit_state.update(ids,add)
+        try:
+            self.model=bspline_model(self.fit_state.solve())
+        except ValueError as ve:
+            self.ui.statLabel.setText("Last fit failed: %s"%ve)
+            return
+        self.residual=self.fit_state.residual()
+        rx,ry=self.get_display_grid()
+        self.DisplaySplineFit(rx,ry)
+        self.show_fit_stats()
+        self.display_residuals()
+    
+    def invalidate_fit(self):
+        '''
+        Flags that the current fit no longer reflects the points to be fitted, such that it needs to be refitted
+        '''
+        if hasattr(self,'fit_state'):
+            del self.fit_state
+        self.changeUpdateBackground()
+        self.unsaved_changes=True
+        self.ui.statLabel.setText("%d points to be fitted, press Fit to update."%np.count_nonzero(self.bool_pnt))
+    
+    def show_fit_stats(self):
+        '''
+        Reports the RMSE of the fit and the worst tile of residuals of points which haven't been removed or cropped
+        '''
+        RSME=np.sqrt(np.mean(self.residual[self.bool_pnt]**2))
+        rms,_,_,_=tile_stats(self.pts[self.bool_pnt],self.residual[self.bool_pnt],self.ui.tileEdit.value())
+        self.ui.statLabel.setText("RSME: %2.2f micron, worst tile RMS: %2.2f micron."%(RSME*1000,np.nanmax(rms,initial=0)*1000))
+    
+    def display_residuals(self):
+        '''
+        Shows the residuals of points which haven't been removed as a colour mapped point cloud in place of the points, or restores the points
+        '''
+        for attr in ('residualActor','residualBar'):
+            if hasattr(self,attr):
+                self.ren.RemoveActor(getattr(self,attr))
+                delattr(self,attr)
+        show=self.ui.showResiduals.isChecked() and hasattr(self,'residual')
+        if hasattr(self,'pointActor'):
+            self.pointActor.SetVisibility(not show)
+        if show:
+            _,self.residualActor,lut=gen_scalar_point_cloud(self.pts[self.bool_pnt],self.residual[self.bool_pnt]*1000,self.PointSize,'residual')
+            self.residualActor.SetScale(1,1,self.Zaspect)
+            if hasattr(self,'clipPlanes'):
+                self.residualActor.GetMapper().SetClippingPlanes(self.clipPlanes)
+            self.residualBar=vtk.vtkScalarBarActor()
+            self.residualBar.SetLookupTable(lut)
+            self.residualBar.SetTitle('Residual (micron)')
+            self.residualBar.SetWidth(0.08)
+            self.ren.AddActor(self.residualActor)
+            self.ren.AddActor(self.residualBar)
+        self.ui.vtkWidget.update()
+    
+    def paint_points(self,ids,color):
+        '''
+        Sets the color of the points with indices ids in a single operation and updates the display
+        '''
+        colors=v2n.vtk_to_numpy(self.colors)
+        colors[ids]=color
+        self.colors.Modified()
+        self.vtkPntsPolyData.GetPointData().SetScalars(self.colors)
+        self.vtkPntsPolyData.Modified()
+        self.ui.vtkWidget.update()
+    
     def write(self):
         
+        if hasattr(self,'model') and np.any(self.cropped):
+            ret=QtWidgets.QMessageBox.warning(self, "pyCM Warning", \
+                "The fit only covers the current section, but will be applied to the whole cut surface by subsequent steps. Write anyway?", \
+                QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No, QtWidgets.QMessageBox.No)
+            if ret == QtWidgets.QMessageBox.No:
+                return
+        
         mat_vars=sio.whosmat(self.fileo)
-        if not set(['spline_x']).isdisjoint([item for sublist in mat_vars for item in sublist]): #tell the user that they might overwrite their data
+        if not set(['spline_x','fit_x','fit_residual']).isdisjoint([item for sublist in mat_vars for item in sublist]): #tell the user that they might overwrite their data
             ret=QtWidgets.QMessageBox.warning(self, "pyCM Warning", \
                 "There is already data associated with this analysis step saved. Overwrite and invalidate subsequent steps?", \
                 QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No, QtWidgets.QMessageBox.No)
@@ -809,14 +1028,31 @@ class surf_int(QtWidgets.QWidget):
                 return
             else:
                 #delete fitting parameters with pyCMcommon helper function, which negates key FEA parameters.
-                clear_mat(self.fileo,['vtk','pickedCornerInd','FEA']) 
+                clear_mat(self.fileo,['vtk','pickedCornerInd','FEA','FEA_filename','FEA_mesh_filename']) 
         
-        if hasattr(self,'tck'): #then spline fitting has been done
+        if hasattr(self,'model'): #then fitting has been done
             mat_contents=sio.loadmat(self.fileo)
-            coefs=[np.reshape(self.tck[2],(len(self.tck[0])-self.tck[3]-1,-1))]
-            number=np.array([len(self.tck[0]),len(self.tck[1])])
-            order=np.array([self.tck[3], self.tck[4]])
-            new={'spline_x': {'form': 'B-', 'knots': [self.tck[0], self.tck[1]], 'kspacing': [self.gx, self.gy], 'coefs': coefs, 'number': number, 'order':order, 'dim': 1, 'tck': self.tck},  'x_out':self.RefOutline, 'aa_mask':self.bool_pnt}
+            if self.model.form=='B-':
+                tck=self.model.tck
+                coefs=[np.reshape(tck[2],(len(tck[0])-tck[3]-1,-1))]
+                number=np.array([len(tck[0]),len(tck[1])])
+                order=np.array([tck[3], tck[4]])
+                key,fit='spline_x',{'form': 'B-', 'knots': [tck[0], tck[1]], 'kspacing': [self.gx, self.gy], 'coefs': coefs, 'number': number, 'order':order, 'dim': 1, 'tck': tck}
+            else:
+                key,fit='fit_x',self.model.to_mat()
+            #only one fitted surface is kept
+            for k in ('spline_x','fit_x','fit_residual'):
+                mat_contents.pop(k,None)
+            #sectioning isn't recorded, only points removed by the user are masked
+            new={key: fit, 'x_out':self.RefOutline, 'aa_mask':self.bool_pnt | self.cropped}
+            if hasattr(self,'residual'): #fitted minus measured height at each point
+                fit['residual']=self.residual
+                #map and tile statistics of points which haven't been removed
+                r=np.where(self.bool_pnt,self.residual,np.nan)
+                z,origin,spacing=residual_raster(self.pts,r,self.raster)
+                tile=self.ui.tileEdit.value()
+                rms,rmax,count,tile_origin=tile_stats(self.pts,r,tile)
+                new['fit_residual']={'z':z, 'origin':origin, 'spacing':spacing, 'tile_size':tile, 'tile_origin':tile_origin, 'tile_rms':rms, 'tile_max':rmax, 'tile_count':count}
             
             mat_contents.update(new)
             
@@ -928,6 +1164,143 @@ def FlipColors(ren,actor,contrast):
             else:
                 actor.GetProperty().SetColor(0.8039, 0.3490, 0.2902)
 
+def fit_spline(p,rmin,rmax,gx,gy,kx,ky):
+    '''
+    Fits a bivariate spline of order kx, ky to the Nx3 points p, with knots from spline_knots, see fit_spline_sparse. Returns tck as per bisplrep, or None if there are too few knots in either direction.
+    '''
+    knots=spline_knots(rmin,rmax,gx,gy,kx,ky)
+    if knots is None:
+        return None
+    return fit_spline_sparse(p, knots[0], knots[1], kx, ky) #get spline representation
+
+def cv_rmse(p,rmin,rmax,gx,gy,kx,ky,folds=5,seed=0):
+    '''
+    Returns the root mean square error of predicting each of folds subsets of points p from a spline fitted to the remainder, see fit_spline. Returns NaN if any fit fails.
+    '''
+    fold=np.random.RandomState(seed).permutation(len(p))%folds
+    sq=0.
+    for f in range(folds):
+        try:
+            tck=fit_spline(p[fold!=f],rmin,rmax,gx,gy,kx,ky)
+        except ValueError:
+            return np.nan
+        if tck is None:
+            return np.nan
+        test=p[fold==f]
+        sq+=np.sum((bisplev_points(test[:,0],test[:,1],tck)-test[:,2])**2)
+    return (sq/len(p))**0.5
+
+def sweep_init(p):
+    '''
+    Process pool initializer so that points are only sent to each worker once
+    '''
+    global sweep_pts
+    sweep_pts=p
+
+def sweep_worker(args):
+    '''
+    Cross validates one combination of fitting parameters on the points held by this worker
+    '''
+    return cv_rmse(sweep_pts,*args)
+
+def spline_sweep(p,rmin,rmax,gxs,gys,kxs,kys,folds=5):
+    '''
+    Cross validates every combination of knot spacings gxs, gys and orders kxs, kys for points p in a process pool, see cv_rmse. Returns an array of RMSE with dimensions len(gxs) x len(gys) x len(kxs) x len(kys).
+    '''
+    combos=[(rmin,rmax,gx,gy,kx,ky,folds) for gx in gxs for gy in gys for kx in kxs for ky in kys]
+    with ProcessPoolExecutor(initializer=sweep_init,initargs=(p,)) as ex:
+        rmse=list(ex.map(sweep_worker,combos))
+    return np.reshape(rmse,(len(gxs),len(gys),len(kxs),len(kys)))
+
+def plot_sweep(rmse,gxs,gys,kxs,kys,n=10,parent=None):
+    '''
+    Shows a heat map of cross validated RMSE over knot spacing for the best orders from spline_sweep, alongside a table of the n best combinations, in a non-modal dialog which is returned so that a reference can be kept
+    '''
+    i,j,k,l=np.unravel_index(np.nanargmin(rmse),rmse.shape)
+    fig=Figure(figsize=(12,5))
+    ax1,ax2=fig.subplots(1,2)
+    
+    im=ax1.imshow(rmse[:,:,k,l].T*1000,origin='lower',cmap='viridis')
+    ax1.set_xticks(range(len(gxs)))
+    ax1.set_xticklabels(['%0.3f'%g for g in gxs])
+    ax1.set_yticks(range(len(gys)))
+    ax1.set_yticklabels(['%0.3f'%g for g in gys])
+    ax1.plot(i,j,'r*',markersize=15)
+    ax1.set_xlabel('Knot spacing (x)')
+    ax1.set_ylabel('Knot spacing (y)')
+    ax1.set_title('Order %d, %d'%(kxs[k],kys[l]))
+    fig.colorbar(im,ax=ax1,label='Cross validated RMSE (micron)')
+    
+    order=np.argsort(rmse,axis=None)[:n]
+    rows=[]
+    for ind in order:
+        a,b,c,d=np.unravel_index(ind,rmse.shape)
+        if np.isnan(rmse[a,b,c,d]):
+            break
+        rows.append(['%0.3f'%gxs[a],'%0.3f'%gys[b],kxs[c],kys[d],'%2.2f'%(rmse[a,b,c,d]*1000)])
+    ax2.axis('off')
+    table=ax2.table(cellText=rows,colLabels=['Spacing (x)','Spacing (y)','Order (x)','Order (y)','RMSE (micron)'],loc='center')
+    table.auto_set_font_size(False)
+    table.set_fontsize(9)
+    table.scale(1,1.4)
+    ax2.set_title('Best combinations')
+    fig.subplots_adjust(left=0.08,right=0.98,bottom=0.12,wspace=0.3)
+    
+    dialog=QtWidgets.QDialog(parent)
+    dialog.setWindowTitle('pyCM - surface fitting parameter sweep')
+    layout=QtWidgets.QVBoxLayout(dialog)
+    layout.addWidget(FigureCanvasQTAgg(fig))
+    dialog.resize(1200,500)
+    dialog.show()
+    return dialog
+
+def residual_raster(pts,r,raster=None,spacing=None):
+    '''
+    Returns residuals r at each of the Nx3 points pts as a raster with rows in y, along with the centre of its first cell and cell dimensions. If raster, as per read_aa, is supplied then pts are its valid cells and its grid is used. Otherwise points are binned and averaged on a grid of spacing, which defaults to the mean nearest neighbour spacing. Empty cells, or those with NaN residuals, are NaN.
+    '''
+    if raster is not None:
+        z=np.full(raster['mask'].shape,np.nan)
+        z[raster['mask']]=r
+        return z,raster['origin'],raster['spacing']
+    
+    if spacing is None:
+        spacing=nn_spacing(pts[:,:2])
+    spacing=np.broadcast_to(np.asarray(spacing,dtype=float),(2,))
+    origin=np.amin(pts[:,:2],axis=0)
+    idx=np.round((pts[:,:2]-origin)/spacing).astype(int)
+    shape=(idx[:,1].max()+1,idx[:,0].max()+1)
+    flat=idx[:,1]*shape[1]+idx[:,0]
+    valid=~np.isnan(r)
+    n=np.bincount(flat[valid],minlength=shape[0]*shape[1])
+    total=np.bincount(flat[valid],r[valid],minlength=shape[0]*shape[1])
+    z=np.full(len(n),np.nan)
+    z[n>0]=total[n>0]/n[n>0]
+    return z.reshape(shape),origin,spacing
+
+def tile_stats(pts,r,tile,origin=None):
+    '''
+    Returns the RMS, maximum absolute value and count of residuals r at points pts over square tiles of dimension tile, starting at origin, which defaults to the minimum x, y of pts. Results are arrays with rows in y, and are NaN for empty tiles. Residuals which are NaN are ignored. The origin of the tiles is also returned.
+    '''
+    valid=~np.isnan(r)
+    p,r=pts[valid,:2],np.abs(r[valid])
+    if len(r)==0:
+        return np.zeros((0,0)),np.zeros((0,0)),np.zeros((0,0),dtype=int),np.zeros(2)
+    if origin is None:
+        origin=np.amin(p,axis=0)
+    idx=np.floor((p-origin)/tile).astype(int)
+    shape=(idx[:,1].max()+1,idx[:,0].max()+1)
+    flat=idx[:,1]*shape[1]+idx[:,0]
+    count=np.bincount(flat,minlength=shape[0]*shape[1])
+    rms=np.full(len(count),np.nan)
+    rms[count>0]=np.sqrt(np.bincount(flat,r**2,minlength=len(count))[count>0]/count[count>0])
+    #maximum of each tile from contiguous runs of sorted tile indices
+    order=np.argsort(flat,kind='stable')
+    f=flat[order]
+    starts=np.concatenate(([0],np.nonzero(np.diff(f))[0]+1))
+    rmax=np.full(len(count),np.nan)
+    rmax[f[starts]]=np.maximum.reduceat(r[order],starts)
+    return rms.reshape(shape),rmax.reshape(shape),count.reshape(shape),origin
+
 if __name__ == "__main__":
     if len(sys.argv)>1:
         sf_def(sys.argv[1])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+Geometric helpers shared by the pyCM modules which depend only on numpy/scipy, and are available through pyCMcommon.
+'''
+__author__ = "M.J. Roy"
+__version__ = "0.1"
+__email__ = "matthew.roy@manchester.ac.uk"
+__status__ = "Experimental"
+__copyright__ = "(c) M. J. Roy, 2014-2017"
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+def poly_mask(poly,x,y):
+    '''
+    Returns a boolean array of shape (len(y),len(x)) which is True where the centres of a regular grid, with ascending x and y coordinates, lie within polygon poly (Nx2 or Nx3, closed or open). Each row is filled between the polygon edges crossing it according to the even-odd rule.
+    '''
+    x0,y0=poly[:,0],poly[:,1]
+    x1,y1=np.roll(x0,-1),np.roll(y0,-1)
+    
+    #rows spanned by each edge, half open to avoid counting shared vertices twice, horizontal edges span none
+    r0=np.searchsorted(y,np.minimum(y0,y1),side='left')
+    r1=np.searchsorted(y,np.maximum(y0,y1),side='left')
+    n=r1-r0
+    e=np.repeat(np.arange(len(x0)),n)
+    rows=np.arange(n.sum())-np.repeat(np.cumsum(n)-n,n)+r0[e]
+    
+    #x location of each crossing and the first column to its right
+    xi=x0[e]+(y[rows]-y0[e])*(x1[e]-x0[e])/(y1[e]-y0[e])
+    cols=np.searchsorted(x,xi,side='right')
+    
+    cross=np.zeros((len(y),len(x)+1),dtype=np.uint8)
+    np.add.at(cross,(rows,cols),1)
+    return np.bitwise_xor.accumulate(cross[:,:-1]&1,axis=1).astype(bool)
+
+def compose_trans(trans):
+    '''
+    Returns a single homogeneous matrix for apply_trans which is equivalent to applying each of the matrices in trans in turn
+    '''
+    T=np.identity(4)
+    for local_trans in trans:
+        local_trans=np.asarray(local_trans)
+        T[0:3,0:3], T[0:3,-1] = np.dot(T[0:3,0:3],local_trans[0:3,0:3]), \
+            np.dot(T[0:3,-1],local_trans[0:3,0:3])+local_trans[0:3,-1]
+    return T
+
+def nn_spacing(pts,sample=None):
+    '''
+    Returns the mean distance between each point in pts (NxM) and its nearest neighbour, using a k-d tree. If sample is an integer, then only a random subset of this many points is queried.
+    '''
+    pts=np.asarray(pts,dtype=float)
+    tree=cKDTree(pts)
+    if sample is not None and sample<len(pts):
+        pts=pts[np.random.choice(len(pts),int(sample),replace=False)]
+    d,_=tree.query(pts,k=2)
+    return np.mean(d[:,1])
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+In-process meshing of an outline into quadrilaterals and their extrusion into hexahedra, as used by preprocess. Depends only on numpy, scipy and matplotlib.
+'''
+__author__ = "M.J. Roy"
+__version__ = "0.1"
+__email__ = "matthew.roy@manchester.ac.uk"
+__status__ = "Experimental"
+__copyright__ = "(c) M. J. Roy, 2014-2017"
+
+import numpy as np
+from scipy.spatial import Delaunay, cKDTree
+from matplotlib import path
+
+def layer_distribution(dist,n,depth):
+    '''
+    Returns the positions of n layers through depth, normalised by depth, which grow geometrically from a first layer thickness of dist. Same as the bias imposed on Gmsh and Abaqus extrusions.
+    '''
+    Bias_u=(depth/float(dist))**(1/float(n-1)) #upper bound
+    B_range=np.linspace(Bias_u/2,Bias_u,1000)
+    Intersection=dist*(1-np.power(B_range,n))/(1-B_range)
+    b=np.where(Intersection>depth)
+    Bias=B_range[b[0][0]]
+
+    L=dist*(1-Bias**np.arange(1,n+1))/(1-float(Bias))
+    L[-1]=depth
+    return L/float(depth)
+
+def cross2d(a,b):
+    '''
+    Returns the z component of the cross product of arrays of 2D vectors a and b
+    '''
+    return a[...,0]*b[...,1]-a[...,1]*b[...,0]
+
+def quad_mesh_outline(outline,h,smooth=5):
+    '''
+    Meshes the region enclosed by outline (ordered, not closed) with quadrilaterals. Interior points on a triangular lattice of spacing h are triangulated with the outline by Delaunay, with outline segments which aren't recovered bisected until they are. Each triangle is then split into three quads via its centroid and edge midpoints, and interior nodes are relaxed by smooth passes of Laplacian smoothing. Returns nodes (Nx2) and quads as counter-clockwise node ids (Mx4).
+    '''
+    outline=np.asarray(outline,dtype=float)[:,:2]
+    poly=path.Path(outline)
+
+    #interior points at least h/2 from the outline
+    xmin,ymin=np.amin(outline,axis=0)
+    xmax,ymax=np.amax(outline,axis=0)
+    y=np.arange(ymin+h/2,ymax,h*np.sqrt(3)/2)
+    x=np.arange(xmin+h/2,xmax,h)
+    X=x[None,:]+(np.arange(len(y))%2)[:,None]*h/2
+    interior=np.column_stack((X.ravel(),np.repeat(y,len(x))))
+    interior=interior[poly.contains_points(interior)]
+    ab=np.roll(outline,-1,axis=0)-outline
+    n=np.ceil(np.linalg.norm(ab,axis=1)/(h/10)).astype(int)
+    seg=np.repeat(np.arange(len(outline)),n)
+    t=np.arange(len(seg))-np.repeat(np.cumsum(n)-n,n)
+    d,_=cKDTree(outline[seg]+(t/np.repeat(n,n))[:,None]*ab[seg]).query(interior)
+    interior=interior[d>=h/2]
+
+    #conforming Delaunay triangulation, bisecting outline segments missing from the triangulation
+    bnd=outline
+    while True:
+        P=np.vstack((bnd,interior))
+        tri=Delaunay(P).simplices.astype(np.int64)
+        tri=tri[poly.contains_points(np.mean(P[tri],axis=1))]
+        e=np.sort(tri[:,[0,1,1,2,2,0]].reshape(-1,2),axis=1)
+        nb=len(bnd)
+        seg=np.sort(np.column_stack((np.arange(nb),np.roll(np.arange(nb),-1))),axis=1)
+        missing=np.nonzero(~np.isin(seg[:,0]*len(P)+seg[:,1],e[:,0]*len(P)+e[:,1]))[0]
+        if len(missing)==0:
+            break
+        bnd=np.insert(bnd,missing+1,(bnd[missing]+np.roll(bnd,-1,axis=0)[missing])/2,axis=0)
+
+    #make all triangles counter-clockwise
+    p=P[tri]
+    cw=cross2d(p[:,1]-p[:,0],p[:,2]-p[:,0])<0
+    tri[cw]=tri[cw][:,::-1]
+
+    #split each triangle into 3 quads with shared edge midpoints
+    e=np.sort(tri[:,[0,1,1,2,2,0]].reshape(-1,2),axis=1)
+    key,mid=np.unique(e[:,0]*len(P)+e[:,1],return_inverse=True)
+    edges=np.column_stack((key//len(P),key%len(P)))
+    mid=mid.reshape(-1,3)+len(P)
+    cent=np.arange(len(tri))+len(P)+len(edges)
+    nodes=np.vstack((P,np.mean(P[edges],axis=1),np.mean(P[tri],axis=1)))
+    quads=np.vstack((np.column_stack((tri[:,0],mid[:,0],cent,mid[:,2])),
+        np.column_stack((tri[:,1],mid[:,1],cent,mid[:,0])),
+        np.column_stack((tri[:,2],mid[:,2],cent,mid[:,1]))))
+
+    #nodes on the outline, being those on edges belonging to a single triangle, are fixed
+    count=np.bincount(mid.ravel()-len(P),minlength=len(edges))
+    fixed=np.zeros(len(nodes),dtype=bool)
+    fixed[edges[count==1].ravel()]=True
+    fixed[len(P)+np.nonzero(count==1)[0]]=True
+
+    #laplacian smoothing, abandoned if any quad would invert
+    qe=np.sort(quads[:,[0,1,1,2,2,3,3,0]].reshape(-1,2),axis=1)
+    key=np.unique(qe[:,0]*len(nodes)+qe[:,1])
+    qe=np.column_stack((key//len(nodes),key%len(nodes)))
+    qe=np.vstack((qe,qe[:,::-1]))
+    valence=np.bincount(qe[:,0],minlength=len(nodes))[:,None]
+    for i in range(smooth):
+        avg=np.column_stack([np.bincount(qe[:,0],weights=nodes[qe[:,1],j],minlength=len(nodes)) for j in range(2)])/valence
+        trial=np.where(fixed[:,None],nodes,avg)
+        q=trial[quads]
+        if np.any(cross2d(q[:,1]-q[:,0],q[:,3]-q[:,0])<=0) or np.any(cross2d(q[:,3]-q[:,2],q[:,1]-q[:,2])<=0):
+            break
+        nodes=trial
+    return nodes, quads
+
+def extrude_quads(nodes,quads,z):
+    '''
+    Sweeps quads (counter-clockwise node ids on nodes, Nx2) through the levels in z, returning nodes (Nx3) and hexahedral connectivity ordered as per VTK
+    '''
+    n=len(nodes)
+    pts=np.column_stack((np.tile(nodes,(len(z),1)),np.repeat(z,n)))
+    k=n*np.arange(len(z)-1)[:,None,None]
+    conn=np.concatenate((quads[None,:,:]+k,quads[None,:,:]+k+n),axis=2).reshape(-1,8)
+    return pts, conn
@@ -271,7 +271,7 @@ class pp_interactor(QtWidgets.QWidget):
                 self.active_scalar_field = "S33"
                 
             except Exception as e:
-                if 'FEA' in mat_contents: #there might be a dat file to read
+                if 'FEA_filename' in mat_contents: #there might be a dat file to read
                     #get dat file
                     FEAbasename=mat_contents['FEA_filename'][0]
                     filename, _ = os.path.splitext(FEAbasename)
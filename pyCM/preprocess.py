@@ -42,13 +42,14 @@ import subprocess as sp
 from pkg_resources import Requirement, resource_filename
 import numpy as np
 import scipy.io as sio
-from scipy.interpolate import bisplev,interp1d
-from scipy.spatial.distance import pdist, squareform
+from scipy.interpolate import interp1d
 import vtk
-from vtk.util.numpy_support import vtk_to_numpy as v2n
+from vtk.util.numpy_support import vtk_to_numpy as v2n, numpy_to_vtk
 from vtk.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 from PyQt5 import QtCore, QtGui, QtWidgets
 from pyCM.pyCMcommon import *
+from pyCM.spline import read_fit_model
+from pyCM.mesher import layer_distribution, quad_mesh_outline, extrude_quads
 
 
 
@@ -159,10 +160,12 @@ class pre_main_window(object):
         self.numPart.setMaximum(10000)
         self.gmshButton=QtWidgets.QRadioButton("Gmsh")
         self.abaButton=QtWidgets.QRadioButton("Abaqus")
+        self.pycmButton=QtWidgets.QRadioButton("pyCM (quads)")
         self.gmshButton.setChecked(True)
         self.codeButtonGroup = QtWidgets.QButtonGroup()
         self.codeButtonGroup.addButton(self.gmshButton)
         self.codeButtonGroup.addButton(self.abaButton)
+        self.codeButtonGroup.addButton(self.pycmButton)
         self.codeButtonGroup.setExclusive(True)
         
         self.quadButton=QtWidgets.QRadioButton("quads")
@@ -235,31 +238,32 @@ class pre_main_window(object):
         mainUiBox.addWidget(meshscriptLabel,8,0,1,2)
         mainUiBox.addWidget(self.gmshButton,9,0,1,1)
         mainUiBox.addWidget(self.abaButton,9,1,1,1)
-        mainUiBox.addWidget(lengthLabel,10,0,1,1)
-        mainUiBox.addWidget(self.lengthInput,10,1,1,1)
-        mainUiBox.addWidget(numPartLabel,11,0,1,1)
-        mainUiBox.addWidget(self.numPart,11,1,1,1)
-        mainUiBox.addWidget(self.quadButton,12,0,1,1)
-        mainUiBox.addWidget(self.tetButton,12,1,1,1)
-        mainUiBox.addWidget(self.meshscriptButton,13,0,1,2)
-        mainUiBox.addWidget(horizLine3,14,0,1,2)
-        mainUiBox.addWidget(bcLabel,15,0,1,2)
-        mainUiBox.addWidget(self.imposeSpline,16,0,1,2)
-        mainUiBox.addWidget(rBLabel,17,0,1,2)
-        mainUiBox.addWidget(self.rigidBodyButton,18,0,1,1)
-        mainUiBox.addWidget(self.rigidBodyUndoButton,18,1,1,1)
-        mainUiBox.addWidget(materialLabel,19,0,1,2)
-        mainUiBox.addWidget(poissonLabel,20,0,1,1)
-        mainUiBox.addWidget(self.poissonInput,20,1,1,1)
-        mainUiBox.addWidget(modulusLabel,21,0,1,1)
-        mainUiBox.addWidget(self.modulusInput,21,1,1,1)
-        mainUiBox.addWidget(horizLine4,22,0,1,2)
-        mainUiBox.addWidget(FEALabel,23,0,1,2)
-        mainUiBox.addWidget(self.CalculixButton,24,0,1,1)
-        mainUiBox.addWidget(self.AbaqusButton,24,1,1,1)
-        mainUiBox.addWidget(self.goButton,25,0,1,1)
-        mainUiBox.addWidget(self.runFEAButton,25,1,1,1)
-        mainUiBox.addWidget(horizLine5,26,0,1,2)
+        mainUiBox.addWidget(self.pycmButton,10,0,1,2)
+        mainUiBox.addWidget(lengthLabel,11,0,1,1)
+        mainUiBox.addWidget(self.lengthInput,11,1,1,1)
+        mainUiBox.addWidget(numPartLabel,12,0,1,1)
+        mainUiBox.addWidget(self.numPart,12,1,1,1)
+        mainUiBox.addWidget(self.quadButton,13,0,1,1)
+        mainUiBox.addWidget(self.tetButton,13,1,1,1)
+        mainUiBox.addWidget(self.meshscriptButton,14,0,1,2)
+        mainUiBox.addWidget(horizLine3,15,0,1,2)
+        mainUiBox.addWidget(bcLabel,16,0,1,2)
+        mainUiBox.addWidget(self.imposeSpline,17,0,1,2)
+        mainUiBox.addWidget(rBLabel,18,0,1,2)
+        mainUiBox.addWidget(self.rigidBodyButton,19,0,1,1)
+        mainUiBox.addWidget(self.rigidBodyUndoButton,19,1,1,1)
+        mainUiBox.addWidget(materialLabel,20,0,1,2)
+        mainUiBox.addWidget(poissonLabel,21,0,1,1)
+        mainUiBox.addWidget(self.poissonInput,21,1,1,1)
+        mainUiBox.addWidget(modulusLabel,22,0,1,1)
+        mainUiBox.addWidget(self.modulusInput,22,1,1,1)
+        mainUiBox.addWidget(horizLine4,23,0,1,2)
+        mainUiBox.addWidget(FEALabel,24,0,1,2)
+        mainUiBox.addWidget(self.CalculixButton,25,0,1,1)
+        mainUiBox.addWidget(self.AbaqusButton,25,1,1,1)
+        mainUiBox.addWidget(self.goButton,26,0,1,1)
+        mainUiBox.addWidget(self.runFEAButton,26,1,1,1)
+        mainUiBox.addWidget(horizLine5,27,0,1,2)
         
 
         lvLayout=QtWidgets.QVBoxLayout()
@@ -334,12 +338,10 @@ class msh_interactor(QtWidgets.QWidget):
             mat_contents = sio.loadmat(self.fileo)
             self.outputd=os.path.split(self.fileo)[0] #needed to write ancillary files.
             try:
-                #read in for ImposeSplineFit function
-                bsplinerep=mat_contents['spline_x']['tck'][0][0]
-                #recast tck as a tuple
-                self.tck=tuple()
-                for j in range(5):
-                    self.tck=self.tck+tuple(bsplinerep[0,j])
+                #read in fitted surface for ImposeSplineFit function
+                self.fit_model=read_fit_model(mat_contents)
+                if self.fit_model is None:
+                    raise KeyError("No fitted surface (spline_x or fit_x) found.")
                 #outline for mesh generation
                 self.Outline=mat_contents['x_out']
                 self.limits = get_limits(self.Outline)
@@ -381,8 +383,7 @@ class msh_interactor(QtWidgets.QWidget):
                         self.ui.dxfButton.setChecked(True)
 
                 else:
-                    gs=squareform(pdist(self.Outline[:,:2],'euclidean')) #does the same thing as MATLAB's pdist2
-                    self.Dist=np.mean(np.sort(gs)[:,1]) #get length of first element
+                    self.Dist=nn_spacing(self.Outline[:,:2]) #mean distance to nearest neighbour
                     self.ui.seedLengthInput.setValue(self.Dist)
                     self.ui.numSeed.setValue(len(self.Outline))
                     print('Found outline.')
@@ -405,28 +406,33 @@ class msh_interactor(QtWidgets.QWidget):
                                 sio.savemat(self.fileo,mat_contents)
                                 print('Wrote to %s\nUpdated record.'%self.vtkFile)
                     
-                    if not os.path.exists(mat_contents['mesh_script_filename'][0]):
-                        print("Couldn't find %s" %mat_contents['mesh_script_filename'][0])
-                        try:
-                            extract_from_mat(mat_contents['mesh_script_filename'][0],self.fileo,'mesh_script')
-                            print('Wrote to %s'%mat_contents['mesh_script_filename'][0])
-                        except:
-                            newpath = os.path.abspath(os.path.join(os.path.dirname(self.fileo),os.path.basename(mat_contents['mesh_script_filename'][0])))
-                            extract_from_mat(newpath,self.fileo,'mesh_script')
-                            mat_contents=sio.loadmat(self.fileo)
-                            new={'mesh_script_filename':newpath}
-                            mat_contents.update(new)
-                            sio.savemat(self.fileo,mat_contents)
-                            print('Wrote to %s\nUpdated record.'%newpath)
-                    
-                    if mat_contents['mesh_script_filename'][0][-4:]=='.geo':
-                        self.geofile=mat_contents['mesh_script_filename'][0]
-                        self.ui.gmshButton.setStyleSheet("background-color :rgb(77, 209, 97);")
-                        self.ui.gmshButton.setChecked(True)
+                    if 'mesh_script' in mat_contents: #otherwise generated by pyCM's own mesher
+                        if not os.path.exists(mat_contents['mesh_script_filename'][0]):
+                            print("Couldn't find %s" %mat_contents['mesh_script_filename'][0])
+                            try:
+                                extract_from_mat(mat_contents['mesh_script_filename'][0],self.fileo,'mesh_script')
+                                print('Wrote to %s'%mat_contents['mesh_script_filename'][0])
+                            except:
+                                newpath = os.path.abspath(os.path.join(os.path.dirname(self.fileo),os.path.basename(mat_contents['mesh_script_filename'][0])))
+                                extract_from_mat(newpath,self.fileo,'mesh_script')
+                                mat_contents=sio.loadmat(self.fileo)
+                                new={'mesh_script_filename':newpath}
+                                mat_contents.update(new)
+                                sio.savemat(self.fileo,mat_contents)
+                                print('Wrote to %s\nUpdated record.'%newpath)
+                        
+                        if mat_contents['mesh_script_filename'][0][-4:]=='.geo':
+                            self.geofile=mat_contents['mesh_script_filename'][0]
+                            self.ui.gmshButton.setStyleSheet("background-color :rgb(77, 209, 97);")
+                            self.ui.gmshButton.setChecked(True)
+                        else:
+                            self.abapyfile=mat_contents['mesh_script_filename'][0]
+                            self.ui.abaButton.setStyleSheet("background-color :rgb(77, 209, 97);")
+                            self.ui.abaButton.setChecked(True)
                     else:
-                        self.abapyfile=mat_contents['mesh_script_filename'][0]
-                        self.ui.abaButton.setStyleSheet("background-color :rgb(77, 209, 97);")
-                        self.ui.abaButton.setChecked(True)
+                        self.pycmfile=self.vtkFile
+                        self.ui.pycmButton.setStyleSheet("background-color :rgb(77, 209, 97);")
+                        self.ui.pycmButton.setChecked(True)
                     self.DisplayMesh()
                     self.ImposeSplineFit()
                     self.ui.lengthInput.setValue(mat_contents['mesh_extrude_depth'][0][0])
@@ -438,7 +444,7 @@ class msh_interactor(QtWidgets.QWidget):
                     self.draw_rigid_body_from_load()
                     # print('Rendering boundary conditions.')
                 
-                if 'FEA' in mat_contents: #then an FEA script has been generated, but may not have been run
+                if 'FEA_filename' in mat_contents: #then an FEA script has been generated, but may not have been run
                     self.ofile_FEA=mat_contents['FEA_filename'][0]
                     self.ui.modulusInput.setValue(mat_contents['Modulus'])
                     self.ui.poissonInput.setValue(mat_contents['Poisson'])
@@ -449,15 +455,30 @@ class msh_interactor(QtWidgets.QWidget):
                         self.ui.CalculixButton.setStyleSheet("background-color :rgb(77, 209, 97);")
                         self.ui.CalculixButton.setChecked(True)
                     if not os.path.exists(self.ofile_FEA):
-                            #run relevant extract_from_mat
-                            print("Couldn't find %s" %self.ofile_FEA)
-                            self.ofile_FEA = os.path.abspath(os.path.join(os.path.dirname(self.fileo),os.path.basename(mat_contents['FEA_filename'][0])))    
+                        #look alongside the results file, or write it out if an older results file embeds it
+                        print("Couldn't find %s" %self.ofile_FEA)
+                        self.ofile_FEA = os.path.abspath(os.path.join(os.path.dirname(self.fileo),os.path.basename(mat_contents['FEA_filename'][0])))
+                        if not os.path.exists(self.ofile_FEA) and 'FEA' in mat_contents:
                             extract_from_mat(self.ofile_FEA,self.fileo,'FEA')
+                            print('Wrote to %s'%self.ofile_FEA)
+                        if os.path.exists(self.ofile_FEA):
                             new={'FEA_filename':self.ofile_FEA}
                             mat_contents.update(new)
                             sio.savemat(self.fileo,mat_contents)
-                            print('Wrote to %s\nUpdated record.'%self.ofile_FEA)
-                    self.preprocessed=True
+                            print('Found %s\nUpdated record.'%self.ofile_FEA)
+                    if 'FEA_mesh_filename' in mat_contents: #deck includes nodes and elements, which need to be alongside it
+                        meshInclude=os.path.join(os.path.dirname(self.ofile_FEA),os.path.basename(mat_contents['FEA_mesh_filename'][0]))
+                        if not os.path.exists(meshInclude) and hasattr(self,'mesh'): #regenerate from the mesh
+                            print("Couldn't find %s" %meshInclude)
+                            self.topology=mesh_topology(self.mesh,self.mainCellType)
+                            self.mesh_cache['topology']=self.topology
+                            self.write_mesh_include(meshInclude)
+                            print('Wrote to %s'%meshInclude)
+                        self.mesh_include=meshInclude
+                    if os.path.exists(self.ofile_FEA):
+                        self.preprocessed=True
+                    else:
+                        print("Couldn't find %s, write the FEA input deck again to run it."%self.ofile_FEA)
                 self.unsaved_changes=False
 
                 
@@ -646,7 +667,7 @@ class msh_interactor(QtWidgets.QWidget):
         
             #update mat file & ui if this is a step back
             #clear anything from the matfile for subsequent steps and reload
-            clear_mat(self.fileo,['FEA','FEA_filename','Modulus','Poisson'])
+            clear_mat(self.fileo,['FEA','FEA_filename','FEA_mesh_filename','Modulus','Poisson'])
             #clear all actors from interactor and set all buttons 'norm'
             
             self.ui.AbaqusButton.setStyleSheet("background-color :None;")
@@ -831,12 +852,13 @@ class msh_interactor(QtWidgets.QWidget):
         
         
         #clear anything from the matfile for subsequent steps and reload
-        clear_mat(self.fileo,['FEA','FEA_filename','mesh_extrude_depth','mesh_partitions','mesh_script','mesh_script_filename','Modulus','pickedCornerInd','corners','Poisson','vtk_inp','vtk_out','vtk_filename','vtu_filename','vtu'])
+        clear_mat(self.fileo,['FEA','FEA_filename','FEA_mesh_filename','mesh_extrude_depth','mesh_partitions','mesh_script','mesh_script_filename','Modulus','pickedCornerInd','corners','Poisson','vtk_inp','vtk_out','vtk_filename','vtu_filename','vtu'])
         #clear all actors from interactor and set all buttons 'norm'
         
         self.ui.dxfButton.setStyleSheet("background-color :None;")
         self.ui.gmshButton.setStyleSheet("background-color :None;")
         self.ui.abaButton.setStyleSheet("background-color :None;")
+        self.ui.pycmButton.setStyleSheet("background-color :None;")
         self.ui.imposeSpline.setStyleSheet("background-color :None;")
         self.ui.rigidBodyButton.setStyleSheet("background-color :None;")
         self.ui.AbaqusButton.setStyleSheet("background-color :None;")
@@ -960,6 +982,7 @@ class msh_interactor(QtWidgets.QWidget):
                 self.ui.statLabel.setText("Gmsh VTK file written . . . Idle")
                 self.ui.gmshButton.setStyleSheet("background-color :rgb(77, 209, 97);")
                 self.ui.abaButton.setStyleSheet("background-color :None;")
+                self.ui.pycmButton.setStyleSheet("background-color :None;")
                 self.ui.imposeSpline.setStyleSheet("background-color :None;")
                 if hasattr(self,'abapyfile'):
                     del self.abapyfile #so logic in WriteGeo works
@@ -993,6 +1016,7 @@ class msh_interactor(QtWidgets.QWidget):
                 self.ui.statLabel.setText("Abaqus .inp file converted . . . Idle")
                 self.ui.abaButton.setStyleSheet("background-color :rgb(77, 209, 97);")
                 self.ui.gmshButton.setStyleSheet("background-color :None;")
+                self.ui.pycmButton.setStyleSheet("background-color :None;")
                 if hasattr(self,'geofile'):
                     del self.geofile
                 self.ui.imposeSpline.setStyleSheet("background-color :None;")
@@ -1002,6 +1026,31 @@ class msh_interactor(QtWidgets.QWidget):
                 print(e)
                 self.ui.statLabel.setText("Abaqus CAE call failed . . . Idle")
                 return False
+        
+        #mesh in-process, extruding quads with the same layers as the Gmsh/Abaqus scripts
+        elif self.ui.pycmButton.isChecked() and hasattr(self,'pycmfile'):
+            self.ui.statLabel.setText("Meshing outline . . .")
+            QtWidgets.QApplication.processEvents()
+            ExtrudeDepth=float(self.ui.lengthInput.value())
+            L=layer_distribution(self.Dist,self.ui.numPart.value(),ExtrudeDepth)
+            nodes,quads=quad_mesh_outline(self.rsOutline,self.Dist)
+            pts,conn=extrude_quads(nodes,quads,np.concatenate(([0],L*ExtrudeDepth)))
+            
+            self.ui.statLabel.setText("Writing VTK file . . .")
+            QtWidgets.QApplication.processEvents()
+            grid=numpy_to_grid(pts,conn,12)
+            writer=vtk.vtkUnstructuredGridWriter()
+            writer.SetFileName(self.pycmfile)
+            writer.SetInputData(grid)
+            writer.Write()
+            self.vtkFile=self.pycmfile
+            #DisplayMesh uses this grid rather than rereading the file
+            self.mesh_cache={'key':(os.path.abspath(self.vtkFile),os.path.getmtime(self.vtkFile)),'mesh':grid,'cell_type':12,'bounds':grid.GetBounds()}
+            self.ui.statLabel.setText("pyCM VTK file written . . . Idle")
+            self.ui.pycmButton.setStyleSheet("background-color :rgb(77, 209, 97);")
+            self.ui.gmshButton.setStyleSheet("background-color :None;")
+            self.ui.abaButton.setStyleSheet("background-color :None;")
+            self.ui.imposeSpline.setStyleSheet("background-color :None;")
         else: 
             self.ui.statLabel.setText("Could not generate mesh . . . Idle")
             return False
@@ -1019,6 +1068,15 @@ class msh_interactor(QtWidgets.QWidget):
                     
                 except:
                     return
+        elif self.ui.pycmButton.isChecked():
+            if not hasattr(self,'pycmfile'):
+                try:
+                    self.pycmfile,_=get_open_file("*.vtk",self.outputd)
+                except:
+                    return
+            if self.ui.tetButton.isChecked():
+                self.ui.statLabel.setText("pyCM mesher only generates quads . . .")
+                self.ui.quadButton.setChecked(True)
         else:
             if not hasattr(self,'ofile'):
                 msg=QtWidgets.QMessageBox()
@@ -1044,18 +1102,7 @@ class msh_interactor(QtWidgets.QWidget):
         
         cent=np.mean(Outline,axis=0)
         
-        Bias_u=(ExtrudeDepth/float(self.Dist))**(1/float(NumNodesDeep-1)) #upper bound
-        B_range=np.linspace(Bias_u/2,Bias_u,1000)
-        Intersection=self.Dist*(1-np.power(B_range,NumNodesDeep))/(1-B_range)
-        b=np.where(Intersection>ExtrudeDepth)
-        Bias=B_range[b[0][0]]
-
-        L=np.array([])
-        for j in range(1,NumNodesDeep+1):
-            L=np.append(L,self.Dist*(1-Bias**j)/(1-float(Bias)))
-
-        L[-1]=ExtrudeDepth
-        L=L/float(ExtrudeDepth)
+        L=layer_distribution(self.Dist,NumNodesDeep,ExtrudeDepth)
         if hasattr(self,"geofile") and self.ui.gmshButton.isChecked():
             pc=0
             lc=0
@@ -1238,7 +1285,11 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
             return
     
         with open(self.vtkFile, 'r') as file: vtkcontents=file.read()
-        if hasattr(self,'geofile'):
+        if self.ui.pycmButton.isChecked(): #no script, mesh is regenerated from the outline
+            new={'vtk_filename':self.vtkFile,'vtk_inp':vtkcontents,'mesh_extrude_depth':ExtrudeDepth,'mesh_partitions':NumNodesDeep}
+            mat_contents.pop('mesh_script',None)
+            mat_contents.pop('mesh_script_filename',None)
+        elif hasattr(self,'geofile'):
             new={'mesh_script_filename':self.geofile,'mesh_script':fid.getvalue(),'vtk_filename':self.vtkFile,'vtk_inp':vtkcontents,'mesh_extrude_depth':ExtrudeDepth,'mesh_partitions':NumNodesDeep}
         else:
             new={'mesh_script_filename':self.abapyfile,'mesh_script':fid.getvalue(),'vtk_filename':self.vtkFile,'vtk_inp':vtkcontents,'mesh_extrude_depth':ExtrudeDepth,'mesh_partitions':NumNodesDeep}
@@ -1251,7 +1302,7 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         
         #update mat file & ui if this is a step back
                 #clear anything from the matfile for subsequent steps and reload
-        clear_mat(self.fileo,['FEA','FEA_filename','Modulus','pickedCornerInd','Poisson'])
+        clear_mat(self.fileo,['FEA','FEA_filename','FEA_mesh_filename','Modulus','pickedCornerInd','Poisson'])
         #clear all actors from interactor and set all buttons 'norm'
         self.ren.RemoveAllViewProps()
         self.ui.imposeSpline.setStyleSheet("background-color :None;")
@@ -1265,8 +1316,11 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
     
         if hasattr(self,"meshActor"):
             self.ren.RemoveActor(self.meshActor)
-            del self.meshSource
             del self.mesh
+            if hasattr(self,"topology"):
+                del self.topology
+            if hasattr(self,"mesh_include"):
+                del self.mesh_include
             if hasattr(self,"BCactor"):
                 self.ren.RemoveActor(self.BCactor)
                 del self.corners
@@ -1277,44 +1331,41 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
                 # self.ren.RemoveActor(self.labelActor) #debug
         if not hasattr(self,"vtkFile"):
             self.vtkFile, startdir = get_file('*.vtk')
-        self.ui.statLabel.setText("Reading . . .")
-        QtWidgets.QApplication.processEvents()
-        self.meshSource=vtk.vtkUnstructuredGridReader()
-        self.meshSource.SetFileName(self.vtkFile)
-        self.meshSource.Update()
         
-        self.ui.statLabel.setText("Filtering out non volumetric elements . . .")
-        QtWidgets.QApplication.processEvents()
-        #mesh as-read
-        om = self.meshSource.GetOutput()
-        #get cell types
-        tcs=vtk.vtkCellTypes()
-        om.GetCellTypes(tcs)
-        #gmsh will return non uniform element types. if it's not a 1st order quad or 1st order tet
-        if tcs.IsType(10)==1:
-            self.mainCellType=10 #2nd order tet
+        #volumetric mesh is only reread and filtered if the file has changed since it was last displayed
+        key=(os.path.abspath(self.vtkFile),os.path.getmtime(self.vtkFile))
+        if getattr(self,'mesh_cache',{}).get('key')==key:
+            self.mesh=self.mesh_cache['mesh']
+            self.mainCellType=self.mesh_cache['cell_type']
+            bounds=self.mesh_cache['bounds']
+            if 'topology' in self.mesh_cache:
+                self.topology=self.mesh_cache['topology']
+        else:
+            self.ui.statLabel.setText("Reading . . .")
+            QtWidgets.QApplication.processEvents()
+            reader=vtk.vtkUnstructuredGridReader()
+            reader.SetFileName(self.vtkFile)
+            reader.Update()
+            
+            self.ui.statLabel.setText("Filtering out non volumetric elements . . .")
+            QtWidgets.QApplication.processEvents()
+            #mesh as-read
+            om = reader.GetOutput()
+            #gmsh will return non uniform element types. if it's not a 1st order quad or 1st order tet
+            cellTypes=cell_types(om)
+            if np.any(cellTypes==10):
+                self.mainCellType=10 #2nd order tet
+            else:
+                self.mainCellType=12 #1st order quad
+            # print "Cells before filtering:",om.GetNumberOfCells() #debug
+            self.mesh=extract_cell_type(om,self.mainCellType)
+            # print "Cells after filtering:",self.mesh.GetNumberOfCells() #debug
+            bounds=self.mesh.GetBounds()
+            self.mesh_cache={'key':key,'mesh':self.mesh,'cell_type':self.mainCellType,'bounds':bounds}
+        if self.mainCellType==10:
             self.ui.tetButton.setChecked(True)
         else:
-            self.mainCellType=12 #1st order quad
             self.ui.quadButton.setChecked(True)
-        # print "Cells before thresholding:",om.GetNumberOfCells() #debug
-        #build int array of types
-        cellTypeArray=vtk.vtkIntArray()
-        cellTypeArray.SetName("Type")
-        cellTypeArray.SetNumberOfComponents(1)
-        cellTypeArray.SetNumberOfTuples(om.GetNumberOfCells())
-        om.GetCellData().AddArray(cellTypeArray)
-        for ind in range(om.GetNumberOfCells()):
-            cellTypeArray.SetValue(ind,om.GetCell(ind).GetCellType())
-        #generate threshold filter
-        t=vtk.vtkThreshold()
-        t.SetInputData(om)
-        t.ThresholdByUpper(self.mainCellType)
-        t.SetInputArrayToProcess(0,0,0,1,"Type")
-        t.Update()
-        
-        self.mesh=t.GetOutput()
-        # print "Cells after thresholding:",self.mesh.GetNumberOfCells() #debug
 
         self.ui.statLabel.setText("Rendering . . .")
         QtWidgets.QApplication.processEvents()
@@ -1322,11 +1373,6 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         # print "Read VTK mesh file:" #debug
         # print "No. points:",self.mesh.GetNumberOfPoints()
         # print "No. elements:",self.mesh.GetNumberOfCells()
-        bounds=self.mesh.GetBounds()
-        
-        edges=vtk.vtkExtractEdges()
-        edges.SetInputConnection(self.meshSource.GetOutputPort())
-        edges.Update()
 
         self.meshMapper=vtk.vtkDataSetMapper()
         self.meshMapper.SetInputData(self.mesh)
@@ -1372,97 +1418,34 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
             
         self.ui.statLabel.setText("Locating surface elements . . .")
         QtWidgets.QApplication.processEvents()
-        #create a locator from a bounding box for candidate cells.
-        #Unless the mesh is highly refined, this locator will id a few layers of elements from the z=0 plane
-        vil = vtk.vtkIdList()
-        locator = vtk.vtkCellTreeLocator()
-        locator.SetDataSet(self.mesh)
-        locator.BuildLocator()
-        locator.FindCellsWithinBounds(self.mesh.GetBounds()[0:4]+(-0.1,self.Dist),vil)
-
-        
-        #vtk datatypes to hold info from locator filter
-        nfaces=vtk.vtkCellArray()
-        rptIds=vtk.vtkIdList()
-        ptIds=vtk.vtkIdList()
-        self.BCelements=np.array([])
-        
-        #push nodes of cells/elements id'ed into data structures
-        count=0
-        for i in range(vil.GetNumberOfIds()):
-            self.mesh.GetFaceStream(vil.GetId(i),ptIds)
-            cellType=self.mesh.GetCellType(vil.GetId(i))
-            if cellType == self.mainCellType:
-                count+=1
-                nfaces.InsertNextCell(ptIds)
-                self.BCelements=np.append(self.BCelements,vil.GetId(i))
-                
-        rawPIds=v2n(nfaces.GetData()) 
+        #boundary faces, elements and nodes are extracted once per mesh
+        if not hasattr(self,'topology'):
+            self.topology=mesh_topology(self.mesh,self.mainCellType)
+            self.mesh_cache['topology']=self.topology
+        meshPts=self.topology.points
         
-        #make new matrix to hold node/point number connectivity
-        if self.mainCellType == 12: #quads
-            SurfPoints=np.resize(rawPIds,(int(len(rawPIds)/float(9)),9))
-            BCunit=4
-            
-        elif self.mainCellType == 10: #tets
-            SurfPoints=np.resize(rawPIds,(int(len(rawPIds)/float(5)),5))
-            BCunit=3
+        #elements with bounds intersecting a few layers of elements from the z=0 plane
+        self.BCelements=self.topology.cells_within_z(-0.1,self.Dist)
         
-        #remove point count column
-        SurfPoints=SurfPoints[:,1::]
+        #nodes on the z=0 plane and their faces in terms of position in BCindex
+        self.BCindex=self.topology.cut['nodes']
+        faceConn=self.topology.cut['local']
+        BCunit=faceConn.shape[1]
         
-        #define vtk data structures for BC display
+        self.ui.statLabel.setText("Imposing nodal displacements . . .")
+        QtWidgets.QApplication.processEvents()
+        #evaluate fitted surface at all surface nodes at once
         BCpnts=vtk.vtkPoints()
-        self.BCcells=vtk.vtkCellArray()
+        BCpnts.SetData(numpy_to_vtk(np.column_stack((meshPts[self.BCindex,:2],
+            self.fit_model.eval_points(meshPts[self.BCindex,0],meshPts[self.BCindex,1]))),deep=1))
         
-        #create array to append all of the points that are found so their id's can be used later to write specific BC's.
-        self.BCindex=np.array([])
+        #build new mesh of shell elements to show the BC surface
+        self.BCcells=vtk.vtkCellArray()
+        set_legacy_cells(self.BCcells,len(faceConn),np.column_stack((np.full(len(faceConn),BCunit),faceConn)).ravel())
         
-        #same for node label display
-        self.BCnodeLabel=vtk.vtkStringArray()
-        self.BCnodeLabel.SetNumberOfComponents(1)
+        #node labels for display
+        self.BCnodeLabel=vtk_id_array(self.BCindex)
         self.BCnodeLabel.SetName("NodeID")
-        
-        self.ui.statLabel.setText("Imposing nodal displacements . . .")
-        QtWidgets.QApplication.processEvents()
-        #build new mesh of shell elements to show the BC surface
-        ccount=0
-        ppcount=0
-
-        for j in SurfPoints: #rows of surfpoints=elements
-            localCell=vtk.vtkPolygon()
-            #need to pre-allocate
-            localCell.GetPointIds().SetNumberOfIds(BCunit)
-            
-            pcount=0
-            for i in j:
-                # count how many points there are with z==0; make sure it's a BCunit's worth
-                if self.mesh.GetPoint(i)[2]==0:
-                    pcount+=1
-            if pcount==BCunit: #then this isn't an element with just one node on the surface (tets)
-                localcellind=0
-                for i in j:
-                    #restart the process
-                    p=self.mesh.GetPoint(i)
-                    if p[2]==0:
-                        #make sure the pnt hasn't been added to the points
-                        if i not in self.BCindex:
-                            #add calculate values for z according to spline
-                            BCpnts.InsertNextPoint(np.append(p[:2],bisplev(p[0],p[1],self.tck)))
-                            self.BCindex=np.append(self.BCindex,i)
-                            localCell.GetPointIds().SetId(localcellind,ppcount)
-                            ppcount+=1
-                        else:
-                            localCell.GetPointIds().SetId(localcellind,
-                                np.where(self.BCindex==i)[0][0])
-                        localcellind+=1
-                        
-                self.BCcells.InsertNextCell(localCell)
-                ccount+=BCunit
-
-        self.BCnodeLabel.SetNumberOfValues(len(self.BCindex))
-        for j in range(len(self.BCindex)):
-            self.BCnodeLabel.SetValue(j,str(int(self.BCindex[j])))
 
         self.ui.statLabel.setText("Rendering . . .")
         QtWidgets.QApplication.processEvents()
@@ -1514,10 +1497,8 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         
         self.ui.statLabel.setText("Finding corners . . .")
         
-        #create np matrix to store surface points (and find corners) -> *FIX*
-        self.BCpnts=v2n(BCpnts.GetData()) #BCsearch will be fast
-        
-        allNodes=v2n(self.mesh.GetPoints().GetData())
+        #create np matrix to store surface points (and find corners)
+        self.BCpnts=v2n(BCpnts.GetData())
 
         c_target=np.array([
         [self.limits[0],self.limits[2]], #xmin,ymin
@@ -1528,16 +1509,11 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         
         self.OutlineIsCCW=False #always will be false based on the order of c_target above
 
-        ind=np.array([])
-        for i in c_target:
-            d=np.array([])
-            for j in self.BCpnts:
-                d=np.append(d,
-                np.sqrt((i[0]-j[0])**2+(i[1]-j[1])**2))
-            ind=np.append(ind,np.where(d==np.amin(d)))
+        #closest surface node to each target in x, y
+        ind=self.topology.closest_nodes(c_target,self.topology.cut)
         
-        self.cornerInd=self.BCindex[ind.astype(int)]
-        self.corners=self.BCpnts[ind.astype(int),:]
+        self.cornerInd=self.BCindex[ind]
+        self.corners=self.BCpnts[ind,:]
         
         
         #back face
@@ -1549,16 +1525,10 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         ])
         
         
-        #create point locator for nodes on back face
-        backCornerLocator=vtk.vtkPointLocator()
-        backCornerLocator.SetDataSet(self.mesh)
-        backCornerLocator.AutomaticOn()
-        backCornerLocator.BuildLocator()
-        
-        for i in bfc_target:
-            target=backCornerLocator.FindClosestPoint(i)
-            self.cornerInd=np.append(self.cornerInd,target)
-            self.corners=np.vstack((self.corners,self.mesh.GetPoint(target)))
+        #closest nodes on back face
+        backInd=self.topology.back['nodes'][self.topology.closest_nodes(bfc_target,self.topology.back)]
+        self.cornerInd=np.append(self.cornerInd,backInd)
+        self.corners=np.vstack((self.corners,meshPts[backInd]))
                         
         self.ui.vtkWidget.update()
         self.ui.vtkWidget.setFocus()
@@ -1654,7 +1624,7 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         
         #Delete any post processing results from results file
         mat_vars=sio.whosmat(self.fileo)
-        if not set(['FEA', 'FEA_filename', 'vtu_filename', 'vtu']).isdisjoint([item for sublist in mat_vars for item in sublist]): #tell the user that they might overwrite their data
+        if not set(['FEA', 'FEA_filename', 'FEA_mesh_filename', 'vtu_filename', 'vtu']).isdisjoint([item for sublist in mat_vars for item in sublist]): #tell the user that they might overwrite their data
             ret=QtWidgets.QMessageBox.warning(self, "pyCM Warning", \
                 "There is already data associated with this analysis step saved. Overwrite and invalidate subsequent steps?", \
                 QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No, QtWidgets.QMessageBox.No)
@@ -1662,7 +1632,7 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
                 return
             else:
                 #delete fitting parameters with pyCMcommon helper function, which negates FEA pre-processing as well.
-                clear_mat(self.fileo,['FEA', 'FEA_filename', 'vtu_filename', 'vtu']) 
+                clear_mat(self.fileo,['FEA', 'FEA_filename', 'FEA_mesh_filename', 'vtu_filename', 'vtu']) 
                 
         #so either there isn't a 'pick' attribute or the number of picks is insufficient
         if not hasattr(self,"picks"):
@@ -1709,86 +1679,61 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         
         
         #catch condition where FEA routines change
-                    
-        fid = io.BytesIO()
-        nodes=v2n(self.mesh.GetPoints().GetData())
-        nodes=np.column_stack((np.arange(1,len(nodes)+1),nodes+1))
-        
-        cells=v2n(self.mesh.GetCells().GetData())
-        #determine element type based on first entry in cells, 8-C3D8, 10-C3D10
-        elType=cells[0]
-        cells=np.resize(cells+1,(int(len(cells)/float(elType+1)),elType+1))
-        cells=np.column_stack((np.arange(1,len(cells)+1),cells[:,1::]))
-
-        #'top' element set
-        nR=len(self.BCelements) % 16 #max no of input entries/line
+        if not hasattr(self,'topology'):
+            self.topology=mesh_topology(self.mesh,self.mainCellType)
+            self.mesh_cache['topology']=self.topology
+        
+        #nodes and elements are written once per mesh to a file included by the deck, and reused if BCs or material change
+        meshInclude=mesh_include_name(self.ofile_FEA)
+        if getattr(self,'mesh_include',None)!=meshInclude or not os.path.exists(meshInclude):
+            self.ui.statLabel.setText("Writing mesh . . .")
+            QtWidgets.QApplication.processEvents()
+            self.write_mesh_include(meshInclude)
         
-        if not nR==0:
-            BCelemsq=np.reshape(self.BCelements[0:-nR],(int(len(self.BCelements[0:-nR])/float(16)),16))
+        self.ui.statLabel.setText("Writing input deck . . .")
+        QtWidgets.QApplication.processEvents()
+        with open(self.ofile_FEA,'wb') as fid:
+            fid.write(str.encode('*HEADING\n'))
             
-        else: #well, the remainder is 0
-            BCelemsq=np.reshape(self.BCelements,(int(len(self.BCelements)/float(16)),16))
-        BCelemsq=BCelemsq+1 #because elements start numbering at 1
-        
-        fid.write(str.encode('*HEADING\n'))
-
-        fid.write(str.encode('**pyCM input deck, converted from VTK format\n'))
-        fid.write(str.encode('**%s\n'%self.ofile_FEA))
-
-        #dump nodes
-        fid.write(str.encode('*NODE\n'))
-        np.savetxt(fid,nodes,fmt='%i,%.6f,%.6f,%.6f',delimiter=',')
-        self.nodes=nodes
-        #dump 'cells'
-        fid.write(str.encode('*ELEMENT, TYPE=C3D%i\n'%elType))
-        np.savetxt(fid,cells,fmt='%i',delimiter=',')
-        self.elements=cells
-        #generate element set to apply material properties
-        fid.write(str.encode('*ELSET, ELSET=DOMAIN, GENERATE\n'))
-        fid.write(str.encode('%i,%i,%i\n'%(1,len(cells),1)))
-        fid.write(str.encode('*ELSET, ELSET=BC\n'))
-        np.savetxt(fid,BCelemsq,fmt='%i',delimiter=',')
-        if not nR==0:
-            for i in self.BCelements[-nR:]:
-                if i==self.BCelements[-1]:
-                    fid.write(str.encode('%i'%(i+1)))
-                else:
-                    fid.write(str.encode('%i,'%(i+1)))
-            fid.write(str.encode('\n'))
-        #write/apply material properties
-        fid.write(str.encode('*SOLID SECTION, ELSET=DOMAIN, MATERIAL=USERSPEC\n'))
-        fid.write(str.encode('*MATERIAL, NAME=USERSPEC\n'))
-        fid.write(str.encode('*ELASTIC, TYPE=ISO\n'))
-        fid.write(str.encode('%7.0f,%.3f\n'%(float(self.ui.modulusInput.value()),float(self.ui.poissonInput.value()))))
-        if self.ui.CalculixButton.isChecked():
-            fid.write(str.encode('*STEP\n'))
-        elif self.ui.AbaqusButton.isChecked():
-            fid.write(str.encode('*STEP, NAME=CONFORM\n'))
-        fid.write(str.encode('*STATIC\n'))
-        fid.write(str.encode('*BOUNDARY\n'))
-        fid.write(str.encode('%i, 1,2, 0\n'%(self.cornerInd[self.pickedCornerInd[0]]+1)))
-        fid.write(str.encode('%i, 2, 0\n'%(self.cornerInd[self.pickedCornerInd[1]]+1)))
-        fid.write(str.encode('*BOUNDARY\n'))
-        for ind in range(len(self.BCindex)):
-            fid.write(str.encode('%i, 3,, %6.6f\n'%(self.BCindex[ind]+1,self.BCpnts[ind,2])))
-        
-        if self.ui.CalculixButton.isChecked():
-            fid.write(str.encode('*EL PRINT, ELSET=DOMAIN\n'))
-            fid.write(str.encode('S\n'))#Coords by default
-            self.ui.CalculixButton.setStyleSheet("background-color :rgb(77, 209, 97);")
-            self.ui.AbaqusButton.setStyleSheet("background-color :None;")
-        elif self.ui.AbaqusButton.isChecked():
-            fid.write(str.encode('*EL PRINT\n'))
-            fid.write(str.encode('COORD,S\n'))#have to specify coords
-            self.ui.AbaqusButton.setStyleSheet("background-color :rgb(77, 209, 97);")
-            self.ui.CalculixButton.setStyleSheet("background-color :None;")
-        fid.write(str.encode('*ENDSTEP'))
+            fid.write(str.encode('**pyCM input deck, converted from VTK format\n'))
+            fid.write(str.encode('**%s\n'%self.ofile_FEA))
+            
+            #nodes, elements and the DOMAIN element set
+            fid.write(str.encode('*INCLUDE, INPUT=%s\n'%os.path.basename(meshInclude)))
+            #'top' element set
+            fid.write(str.encode('*ELSET, ELSET=BC\n'))
+            write_inp_ids(fid,self.BCelements+1) #because elements start numbering at 1
+            #write/apply material properties
+            fid.write(str.encode('*SOLID SECTION, ELSET=DOMAIN, MATERIAL=USERSPEC\n'))
+            fid.write(str.encode('*MATERIAL, NAME=USERSPEC\n'))
+            fid.write(str.encode('*ELASTIC, TYPE=ISO\n'))
+            fid.write(str.encode('%7.0f,%.3f\n'%(float(self.ui.modulusInput.value()),float(self.ui.poissonInput.value()))))
+            if self.ui.CalculixButton.isChecked():
+                fid.write(str.encode('*STEP\n'))
+            elif self.ui.AbaqusButton.isChecked():
+                fid.write(str.encode('*STEP, NAME=CONFORM\n'))
+            fid.write(str.encode('*STATIC\n'))
+            fid.write(str.encode('*BOUNDARY\n'))
+            fid.write(str.encode('%i, 1,2, 0\n'%(self.cornerInd[self.pickedCornerInd[0]]+1)))
+            fid.write(str.encode('%i, 2, 0\n'%(self.cornerInd[self.pickedCornerInd[1]]+1)))
+            fid.write(str.encode('*BOUNDARY\n'))
+            write_inp_rows(fid,'%i, 3,, %6.6f',np.column_stack((self.BCindex+1,self.BCpnts[:,2])))
+            
+            if self.ui.CalculixButton.isChecked():
+                fid.write(str.encode('*EL PRINT, ELSET=DOMAIN\n'))
+                fid.write(str.encode('S\n'))#Coords by default
+                self.ui.CalculixButton.setStyleSheet("background-color :rgb(77, 209, 97);")
+                self.ui.AbaqusButton.setStyleSheet("background-color :None;")
+            elif self.ui.AbaqusButton.isChecked():
+                fid.write(str.encode('*EL PRINT\n'))
+                fid.write(str.encode('COORD,S\n'))#have to specify coords
+                self.ui.AbaqusButton.setStyleSheet("background-color :rgb(77, 209, 97);")
+                self.ui.CalculixButton.setStyleSheet("background-color :None;")
+            fid.write(str.encode('*ENDSTEP'))
 
-        #write contents to file, highlight relevant button
+        #record paths to the deck and the mesh it includes in results file, highlight relevant button
         mat_contents=sio.loadmat(self.fileo)
-        new={'FEA_filename':self.ofile_FEA,'FEA':fid.getvalue(),'Modulus':float(self.ui.modulusInput.value()),'Poisson':float(self.ui.poissonInput.value())}
-        with open(self.ofile_FEA, 'w+') as f: f.write(fid.getvalue().decode("utf-8"))
-        fid.close()
+        new={'FEA_filename':self.ofile_FEA,'FEA_mesh_filename':meshInclude,'Modulus':float(self.ui.modulusInput.value()),'Poisson':float(self.ui.poissonInput.value())}
         mat_contents.update(new)
         sio.savemat(self.fileo,mat_contents)
         
@@ -1797,7 +1742,7 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         #Because duplicate entities exist during GMSH's procedure, the mesh is filtered. This changes the order of entities (node numbering and element numbering), so that the *.inp file & vtk file that is generated by Abaqus CAE meshing will not reflect the final .abq.inp file. Therefore, the initial vtk file is over-written for post-processing purposes.
         self.ui.statLabel.setText("Writing new VTK file reflecting FEA packaging . . .")
 
-        ConvertInptoVTK(self.ofile_FEA,self.vtkFile[0:-4]+'_out.vtk')
+        ConvertInptoVTK(meshInclude,self.vtkFile[0:-4]+'_out.vtk')
         with open(self.vtkFile[0:-4]+'_out.vtk', 'r') as file: vtkcontents_out=file.read()
         
         new={'vtk_out':vtkcontents_out}
@@ -1814,6 +1759,32 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         self.unsaved_changes = False
         self.preprocessed = True
         
+    def write_mesh_include(self,filename):
+        '''
+        Writes nodes, elements and the DOMAIN element set of the current mesh to filename, for inclusion in input decks
+        '''
+        nodes=self.topology.points
+        nodes=np.column_stack((np.arange(1,len(nodes)+1),nodes+1))
+        cells=np.column_stack((self.topology.cell_ids+1,self.topology.conn+1))
+        with open(filename,'wb') as fid:
+            fid.write(str.encode('**pyCM mesh, converted from VTK format\n'))
+            #dump nodes
+            fid.write(str.encode('*NODE\n'))
+            write_inp_rows(fid,'%i,%.6f,%.6f,%.6f',nodes)
+            #dump 'cells', 8-C3D8, 4-C3D4
+            fid.write(str.encode('*ELEMENT, TYPE=C3D%i\n'%self.topology.conn.shape[1]))
+            write_inp_rows(fid,','.join(['%i']*cells.shape[1]),cells)
+            #generate element set to apply material properties
+            if np.all(np.diff(cells[:,0])==1):
+                fid.write(str.encode('*ELSET, ELSET=DOMAIN, GENERATE\n'))
+                fid.write(str.encode('%i, %i, 1\n'%(cells[0,0],cells[-1,0])))
+            else:
+                fid.write(str.encode('*ELSET, ELSET=DOMAIN\n'))
+                write_inp_ids(fid,cells[:,0])
+        self.nodes=nodes
+        self.elements=cells
+        self.mesh_include=filename
+    
     #Deprecated
     '''
     def WriteOutput(self):
@@ -1884,6 +1855,33 @@ session.viewports['Viewport: 1'].view.fitView()\n"""
         
 
 
+def mesh_include_name(deck):
+    '''
+    Returns the name of the file containing the mesh included by the input deck, being the deck with its .ccx.inp or .abq.inp suffix replaced by _mesh.inp
+    '''
+    for ext in ('.ccx.inp','.abq.inp'):
+        if deck.endswith(ext):
+            return deck[:-len(ext)]+'_mesh.inp'
+    return os.path.splitext(deck)[0]+'_mesh.inp'
+
+def write_inp_rows(fid,fmt,rows,chunk=50000):
+    '''
+    Writes rows of a 2D array to the open binary file fid, formatting each according to fmt a chunk of rows at a time
+    '''
+    for i in range(0,len(rows),chunk):
+        block=rows[i:i+chunk]
+        fid.write(str.encode((fmt+'\n')*len(block)%tuple(block.ravel())))
+
+def write_inp_ids(fid,ids,per_line=16):
+    '''
+    Writes integer ids to the open binary file fid as comma delimited lines of per_line entries, being the maximum for sets in input decks
+    '''
+    ids=np.asarray(ids,dtype=int)
+    n=len(ids)-len(ids)%per_line
+    write_inp_rows(fid,','.join(['%i']*per_line),ids[:n].reshape(-1,per_line))
+    if n<len(ids):
+        write_inp_rows(fid,','.join(['%i']*(len(ids)-n)),ids[n:].reshape(1,-1))
+
 def ConvertInptoVTK(infile,outfile):
     """
     Converts abaqus inp file into a legacy ASCII vtk file. First order quads (C3D8) and third order tets (C3D10) are supported.
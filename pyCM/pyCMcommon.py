@@ -19,6 +19,7 @@ import h5py
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
+from pyCM.geometry import poly_mask, compose_trans, nn_spacing
 
 
 def get_file(*args):
@@ -116,6 +117,39 @@ def extract_from_mat(targetfile,matfile,field):
     fid.write('%s'%mat_contents[field][0])
     fid.close()
 
+def raster_to_pnts(z,origin,spacing,mask=None):
+    '''
+    Returns an Nx3 array of points from the valid cells of a raster z, where rows correspond to y and columns to x, with the centre of the first cell at origin and cell dimensions of spacing. If mask isn't supplied, all cells which aren't NaN are considered valid.
+    '''
+    if mask is None:
+        mask=~np.isnan(z)
+    iy,ix=np.nonzero(mask)
+    return np.column_stack((origin[0]+ix*spacing[0],origin[1]+iy*spacing[1],z[iy,ix]))
+
+def read_aa(mat_contents):
+    '''
+    Reads aligned and averaged data from the contents of a *.mat file. Returns an Nx3 array of valid points, the grid size and a dictionary containing the raster representation (z, origin, spacing, unpacked mask and any per-cell diff, std and count), which is None if the data was stored as scattered points. Values are stored for valid cells only, so rasters are NaN (or zero count) elsewhere.
+    '''
+    aa=mat_contents['aa']
+    gsize=float(np.squeeze(aa['gsize'][0][0]))
+    if 'z' in aa.dtype.names:
+        shape=tuple(aa['shape'][0][0].ravel().astype(int))
+        mask=np.unpackbits(aa['mask'][0][0].ravel())[:np.prod(shape)].reshape(shape).astype(bool)
+        raster={'origin':aa['origin'][0][0].ravel(),
+            'spacing':aa['spacing'][0][0].ravel(),
+            'mask':mask}
+        for field in ['z','diff','std','count']: #heights and per-cell statistics
+            if field in aa.dtype.names:
+                values=aa[field][0][0].ravel()
+                raster[field]=np.zeros(shape,dtype=values.dtype) if field=='count' else np.full(shape,np.nan)
+                raster[field][mask]=values
+        pts=raster_to_pnts(raster['z'],raster['origin'],raster['spacing'],mask)
+    else:
+        raster=None
+        pts=aa['pnts'][0][0]
+        pts=pts[~np.isnan(pts).any(axis=1)] #remove all nans
+    return pts, gsize, raster
+
 def gen_point_cloud(pts,color,size):
     '''
     Returns vtk objects and actor for a point cloud having size points and color mapped to z limits
@@ -156,6 +190,57 @@ def gen_point_cloud(pts,color,size):
     actor.GetProperty().SetPointSize(size)
     return pC, actor, colors
 
+def gen_scalar_point_cloud(pts,scalars,size,name='scalars'):
+    '''
+    Returns vtk objects and actor for a point cloud having size points, coloured by scalars from blue (minimum) to red (maximum). Returns the polydata, actor and lookup table.
+    '''
+    n=len(pts)
+    vtkPnts = vtk.vtkPoints()
+    vtkPnts.SetData(vtk_to_numpy.numpy_to_vtk(np.ascontiguousarray(pts,dtype=float),deep=1))
+    
+    #one vertex per point, each cell being [1, point id]
+    cells=np.column_stack((np.ones(n),np.arange(n))).ravel()
+    vtkVerts = vtk.vtkCellArray()
+    set_legacy_cells(vtkVerts,n,cells)
+    
+    values=vtk_to_numpy.numpy_to_vtk(np.ascontiguousarray(scalars,dtype=float),deep=1)
+    values.SetName(name)
+    
+    pC = vtk.vtkPolyData()
+    pC.SetPoints(vtkPnts)
+    pC.SetVerts(vtkVerts)
+    pC.GetPointData().SetScalars(values)
+    
+    lut = vtk.vtkLookupTable()
+    lut.SetHueRange(0.667, 0)
+    lut.Build()
+    
+    vtkPntMapper = vtk.vtkDataSetMapper()
+    vtkPntMapper.SetInputData(pC)
+    vtkPntMapper.SetScalarRange(np.nanmin(scalars),np.nanmax(scalars))
+    vtkPntMapper.SetLookupTable(lut)
+    
+    actor=vtk.vtkActor()
+    actor.SetMapper(vtkPntMapper)
+    actor.GetProperty().SetPointSize(size)
+    return pC, actor, lut
+
+def vtk_id_array(ids):
+    '''
+    Returns a vtkIdTypeArray copy of ids, cast to the integer type vtkIdType has in the installed version of VTK
+    '''
+    dtype=vtk_to_numpy.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+    return vtk_to_numpy.numpy_to_vtkIdTypeArray(np.ascontiguousarray(ids,dtype=dtype),deep=1)
+
+def set_legacy_cells(cell_array,n,cells):
+    '''
+    Sets the n cells of vtkCellArray cell_array from point ids in the legacy format of [number of points, ids . . .] for each cell
+    '''
+    if hasattr(cell_array,'ImportLegacyFormat'): #VTK 9 and later
+        cell_array.ImportLegacyFormat(vtk_id_array(cells))
+    else:
+        cell_array.SetCells(n,vtk_id_array(cells))
+
 def get_limits(pts):
     '''
     Returns a bounding box with x,y values bumped out by 10% for generating 3D axes
@@ -435,13 +520,150 @@ def respace_equally(X,input):
     X_new=np.stack((Xnew,Ynew),axis=-1)
     return X_new,Perimeter,nPts
 
-def best_fit_transform(A, B):
+def cell_types(grid):
+    '''
+    Returns the VTK cell type of each cell of an unstructured grid as an array
+    '''
+    try:
+        types=grid.GetCellTypes() #VTK 9.6 and later, any array type
+    except TypeError:
+        types=grid.GetCellTypesArray()
+    if types is not None:
+        return vtk_to_numpy.vtk_to_numpy(types)
+    return np.array([grid.GetCellType(i) for i in range(grid.GetNumberOfCells())],dtype=np.uint8)
+
+def cell_connectivity(grid,cell_type):
+    '''
+    Returns the point ids of all cells of cell_type in the unstructured grid as an array with one row per cell, along with the ids of those cells
+    '''
+    ids=np.where(cell_types(grid)==cell_type)[0]
+    cells=grid.GetCells()
+    if hasattr(cells,'GetOffsetsArray'): #VTK 9 and later
+        offsets=vtk_to_numpy.vtk_to_numpy(cells.GetOffsetsArray())
+        conn=vtk_to_numpy.vtk_to_numpy(cells.GetConnectivityArray())
+        start=offsets[ids]
+        n=offsets[ids[0]+1]-offsets[ids[0]] if len(ids) else 0
+    else: #legacy cell array of [number of points, ids . . .]
+        conn=vtk_to_numpy.vtk_to_numpy(cells.GetData())
+        locations=vtk_to_numpy.vtk_to_numpy(grid.GetCellLocationsArray())
+        start=locations[ids]+1
+        n=conn[locations[ids[0]]] if len(ids) else 0
+    return conn[start[:,None]+np.arange(n)], ids
+
+def numpy_to_grid(points,conn,cell_type):
+    '''
+    Returns an unstructured grid of cell_type elements, with point coordinates (Nx3) and connectivity (one row of point ids per cell) supplied as arrays
+    '''
+    vtkPnts=vtk.vtkPoints()
+    vtkPnts.SetData(vtk_to_numpy.numpy_to_vtk(np.ascontiguousarray(points,dtype=float),deep=1))
+    cells=np.column_stack((np.full(len(conn),conn.shape[1]),conn)).ravel()
+    vtkCells=vtk.vtkCellArray()
+    set_legacy_cells(vtkCells,len(conn),cells)
+    grid=vtk.vtkUnstructuredGrid()
+    grid.SetPoints(vtkPnts)
+    grid.SetCells(cell_type,vtkCells)
+    return grid
+
+def extract_cell_type(grid,cell_type):
+    '''
+    Returns a new unstructured grid with only the cell_type elements of grid, discarding points not belonging to them. Points retain their original order.
+    '''
+    conn,_=cell_connectivity(grid,cell_type)
+    used,local=np.unique(conn,return_inverse=True)
+    points=vtk_to_numpy.vtk_to_numpy(grid.GetPoints().GetData())[used]
+    return numpy_to_grid(points,local.reshape(conn.shape),cell_type)
+
+class mesh_topology(object):
+    '''
+    Boundary topology of the cell_type elements of an unstructured grid, extracted once on construction. Boundary faces, being those belonging to only one element, are classified by their outward normals as lying on the cut surface (z=0), the back face (maximum z) or the sides. The cut, back and side dictionaries contain the face node ids ('faces'), the ids of elements having those faces ('elements'), node ids in order of first appearance ('nodes') and faces in terms of position in nodes ('local').
+    '''
+    #faces of linear tets and hexahedra in terms of element nodes, as per VTK
+    face_table={10: [[0,1,3],[1,2,3],[2,0,3],[0,2,1]],
+        12: [[0,3,2,1],[4,5,6,7],[0,1,5,4],[1,2,6,5],[2,3,7,6],[3,0,4,7]]}
+    
+    def __init__(self,grid,cell_type,tol=1e-3):
+        self.points=vtk_to_numpy.vtk_to_numpy(grid.GetPoints().GetData())
+        self.conn,self.cell_ids=cell_connectivity(grid,cell_type)
+        table=np.array(self.face_table[cell_type])
+        nf,k=table.shape
+        
+        #faces which appear only once, once their node ids are sorted, are on the boundary
+        faces=self.conn[:,table].reshape(-1,k)
+        key=np.sort(faces,axis=1)
+        order=np.lexsort(key.T[::-1])
+        dup=np.all(key[order[1:]]==key[order[:-1]],axis=1)
+        single=np.ones(len(faces),dtype=bool)
+        single[order[1:][dup]]=False
+        single[order[:-1][dup]]=False
+        idx=np.nonzero(single)[0]
+        faces,cells=faces[idx],idx//nf
+        
+        #unit normals, made outward by comparing to element centroids
+        p=self.points[faces]
+        n=np.cross(p[:,2]-p[:,0],p[:,-1]-p[:,1])
+        n/=np.linalg.norm(n,axis=1)[:,None]
+        outward=np.einsum('ij,ij->i',n,p.mean(axis=1)-self.points[self.conn[cells]].mean(axis=1))
+        n[outward<0]*=-1
+        self.normals=n
+        
+        z=p[:,:,2]
+        zmax=np.amax(self.points[:,2])
+        cut=np.all(z==0,axis=1)
+        back=(n[:,2]>1-tol) & np.all(np.abs(z-zmax)<=tol*np.ptp(self.points[:,2]),axis=1)
+        side=~(cut | back)
+        self.cut=self.face_set(faces[cut],self.cell_ids[cells[cut]])
+        self.back=self.face_set(faces[back],self.cell_ids[cells[back]])
+        self.side=self.face_set(faces[side],self.cell_ids[cells[side]])
+    
+    @staticmethod
+    def face_set(faces,elements):
+        '''
+        Returns dictionary of faces, unique elements, nodes in order of first appearance and faces in terms of position in nodes
+        '''
+        uniq,first=np.unique(faces,return_index=True)
+        nodes=uniq[np.argsort(first)]
+        position=np.zeros(np.amax(faces,initial=0)+1,dtype=int)
+        position[nodes]=np.arange(len(nodes))
+        return {'faces':faces, 'elements':np.unique(elements), 'nodes':nodes, 'local':position[faces]}
+    
+    def cells_within_z(self,z0,z1):
+        '''
+        Returns the ids of elements with z bounds overlapping z0 to z1
+        '''
+        zc=self.points[self.conn,2]
+        return self.cell_ids[(zc.min(axis=1)<=z1) & (zc.max(axis=1)>=z0)]
+    
+    def closest_nodes(self,targets,face_set):
+        '''
+        Returns the position in face_set['nodes'] of the node closest to each of targets, which have either x, y or x, y, z coordinates
+        '''
+        targets=np.atleast_2d(targets)
+        p=self.points[face_set['nodes'],:targets.shape[1]]
+        return np.argmin(np.sum((targets[:,None,:]-p[None,:,:])**2,axis=2),axis=1)
+
+def apply_trans(P,T,inplace=False,chunk=1000000):
+    '''
+    Apply rotation/reflection and translation in homogeneous matrix T on a discrete basis to a Nx3 point cloud P. If inplace, then P (float32 or float64) is overwritten chunk points at a time to limit temporary memory, and returned.
+    '''
+    T=np.asarray(T)
+    if not inplace:
+        return np.dot(P,T[0:3,0:3])+T[0:3,-1]
+    
+    R=T[0:3,0:3].astype(P.dtype)
+    t=T[0:3,-1].astype(P.dtype)
+    for i in range(0,len(P),chunk):
+        block=P[i:i+chunk]
+        block[:]=np.dot(block,R)+t
+    return P
+
+def best_fit_transform(A, B, W=None):
     '''
     Copyright 2016 Clay Flannigan
     Calculates the least-squares best-fit transform that maps corresponding points A to B in m spatial dimensions
     Input:
     A: Nxm numpy array of corresponding points
     B: Nxm numpy array of corresponding points
+    W: optional N array of weights for each correspondence, e.g. from huber_weights
     Returns:
     T: (m+1)x(m+1) homogeneous transformation matrix that maps A on to B
     R: mxm rotation matrix
@@ -453,14 +675,18 @@ def best_fit_transform(A, B):
     # get number of dimensions
     m = A.shape[1]
     
-    # translate points to their centroids
-    centroid_A = np.mean(A, axis=0)
-    centroid_B = np.mean(B, axis=0)
+    if W is None:
+        W = np.ones(A.shape[0])
+    W = W/np.sum(W)
+    
+    # translate points to their (weighted) centroids
+    centroid_A = np.dot(W, A)
+    centroid_B = np.dot(W, B)
     AA = A - centroid_A
     BB = B - centroid_B
     
     # rotation matrix
-    H = np.dot(AA.T, BB)
+    H = np.dot(AA.T*W, BB)
     U, S, Vt = np.linalg.svd(H)
     R = np.dot(Vt.T, U.T)
     
@@ -479,6 +705,15 @@ def best_fit_transform(A, B):
     
     return T, R, t
 
+def huber_weights(r, delta):
+    '''
+    Returns Huber weights for residuals r: unity for residuals smaller than delta, delta/|r| otherwise.
+    '''
+    r = np.abs(r)
+    w = np.ones(len(r))
+    big = r > delta
+    w[big] = delta/r[big]
+    return w
 
 def nearest_neighbor(src, dst):
     '''
@@ -500,7 +735,7 @@ def nearest_neighbor(src, dst):
     return distances.ravel(), indices.ravel()
 
 
-def icp(A, B, init_pose=None, max_iterations=100, tolerance=0.0001):
+def icp(A, B, init_pose=None, max_iterations=100, tolerance=0.0001, keep=1.0, huber=None):
     '''
     Copyright 2016 Clay Flannigan
     The Iterative Closest Point method: finds best-fit transform that maps points A on to points B
@@ -510,6 +745,8 @@ def icp(A, B, init_pose=None, max_iterations=100, tolerance=0.0001):
         init_pose: (m+1)x(m+1) homogeneous transformation
         max_iterations: exit algorithm after max_iterations
         tolerance: convergence criteria
+        keep: fraction of correspondences with the smallest distances retained each iteration (trimmed ICP), 1.0 retains all
+        huber: if not None, weight retained correspondences with Huber weights, the threshold being huber times the median retained distance
     Output:
         T: final homogeneous transformation that maps A on to B
         distances: Euclidean distances (errors) of the nearest neighbor
@@ -531,20 +768,33 @@ def icp(A, B, init_pose=None, max_iterations=100, tolerance=0.0001):
     if init_pose is not None:
         src = np.dot(init_pose, src)
 
+    # number of correspondences retained per iteration
+    nkeep = max(m+1, int(round(keep*A.shape[0])))
+
     prev_error = 0
 
     for i in range(max_iterations):
         # find the nearest neighbors between the current source and destination points
         distances, indices = nearest_neighbor(src[:m,:].T, dst[:m,:].T)
 
+        # retain the best correspondences only
+        if nkeep < len(distances):
+            inliers = np.argpartition(distances, nkeep-1)[:nkeep]
+        else:
+            inliers = np.arange(len(distances))
+
+        W = None
+        if huber is not None:
+            W = huber_weights(distances[inliers], huber*np.median(distances[inliers]) + np.finfo(float).eps)
+
         # compute the transformation between the current source and nearest destination points
-        T,_,_ = best_fit_transform(src[:m,:].T, dst[:m,indices].T)
+        T,_,_ = best_fit_transform(src[:m,inliers].T, dst[:m,indices[inliers]].T, W)
 
         # update the current source
         src = np.dot(T, src)
 
         # check error
-        mean_error = np.mean(distances)
+        mean_error = np.mean(distances[inliers])
         if np.abs(prev_error - mean_error) < tolerance:
             break
         prev_error = mean_error
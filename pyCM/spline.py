@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+'''
+Vectorized evaluation of bivariate B-splines as returned by bisplrep (or fit_surface) at scattered points and on grids, including partial derivatives, sparse least squares and robust spline fitting, and the surface models fitted by fit_surface and read by preprocess. Depends only on numpy/scipy.
+'''
+__author__ = "M.J. Roy"
+__version__ = "0.1"
+__email__ = "matthew.roy@manchester.ac.uk"
+__status__ = "Experimental"
+__copyright__ = "(c) M. J. Roy, 2014-2017"
+
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sparse
+from scipy.sparse.linalg import splu
+
+#least recently used cache of basis evaluations, keyed on the memory holding the evaluation points, knots and order
+_basis_cache=OrderedDict()
+cache_bytes=128*2**20 #limit on the size of cached evaluations and the points they hold
+
+def unpack_tck(tck):
+    '''
+    Returns tx, ty, c, kx, ky from tck as per bisplrep, or as read back from a *.mat file, as flattened arrays and integers
+    '''
+    tx,ty,c,kx,ky=tck[:5]
+    return np.ravel(tx).astype(float), np.ravel(ty).astype(float), np.ravel(c).astype(float), int(np.ravel(kx)[0]), int(np.ravel(ky)[0])
+
+def bspl_basis(x,t,k):
+    '''
+    Evaluates the k+1 non-zero B-spline basis functions of degree k with knots t at each of x by de Boor's recursion. Returns the index of the first non-zero basis function for each point and an array of their values (len(x) by k+1). Points outside the knot range are clamped to it, as per bisplev.
+    '''
+    n=len(t)-k-1 #number of coefficients
+    x=np.clip(np.asarray(x,dtype=float),t[k],t[n])
+    l=np.clip(np.searchsorted(t,x,side='right')-1,k,n-1)
+
+    N=np.zeros((len(x),k+1))
+    N[:,0]=1.0
+    left=np.zeros((len(x),k+1))
+    right=np.zeros((len(x),k+1))
+    for j in range(1,k+1):
+        left[:,j]=x-t[l+1-j]
+        right[:,j]=t[l+j]-x
+        saved=np.zeros(len(x))
+        for r in range(j):
+            temp=N[:,r]/(right[:,r+1]+left[:,j-r])
+            N[:,r]=saved+right[:,r+1]*temp
+            saved=left[:,j-r]*temp
+        N[:,j]=saved
+    return l-k, N
+
+def cached_basis(x,t,k):
+    '''
+    As per bspl_basis, but returns the stored result if the same array x has been recently evaluated with t and k. Arrays are identified by their memory rather than contents, so clear_cache needs to be called if x is modified in place. Least recently used results are discarded to keep the cache within cache_bytes.
+    '''
+    x=np.asarray(x)
+    t=np.ascontiguousarray(t,dtype=float)
+    key=(x.__array_interface__['data'][0],x.shape,x.strides,x.dtype.str,t.tobytes(),k)
+    if key in _basis_cache:
+        _basis_cache.move_to_end(key)
+        return _basis_cache[key][1]
+    result=bspl_basis(np.ravel(x),t,k)
+    size=x.nbytes+result[0].nbytes+result[1].nbytes
+    if size<=cache_bytes:
+        #x is held so that its memory can't be reused by another array while cached
+        _basis_cache[key]=(x,result,size)
+        while sum(v[2] for v in _basis_cache.values())>cache_bytes:
+            _basis_cache.popitem(last=False)
+    return result
+
+def clear_cache():
+    '''
+    Empties the basis cache, such as when evaluation points are modified or no longer needed
+    '''
+    _basis_cache.clear()
+
+def spline_der(t,c,k,d,axis):
+    '''
+    Returns the knots, coefficients and order of the d'th derivative of a spline with knots t, coefficients c (array with coefficients along axis) and order k
+    '''
+    for i in range(d):
+        if k==0:
+            raise ValueError("Derivative order exceeds spline order.")
+        dt=t[k+1:-1]-t[1:-k-1]
+        dt[dt==0]=1.
+        shape=[1]*c.ndim
+        shape[axis]=-1
+        c=k*np.diff(c,axis=axis)/dt.reshape(shape)
+        t=t[1:-1]
+        k-=1
+    return t,c,k
+
+def deriv_tck(tck,dx=0,dy=0):
+    '''
+    Returns the knots, coefficients as an array (nx by ny) and orders of the partial derivative dx, dy of tck
+    '''
+    tx,ty,c,kx,ky=unpack_tck(tck)
+    c=c.reshape(len(tx)-kx-1,len(ty)-ky-1)
+    tx,c,kx=spline_der(tx,c,kx,dx,0)
+    ty,c,ky=spline_der(ty,c,ky,dy,1)
+    return tx,ty,c,kx,ky
+
+def basis_matrix(x,t,k):
+    '''
+    Returns the sparse matrix (len(x) by number of coefficients) of B-spline basis functions with knots t and order k evaluated at x
+    '''
+    i,N=cached_basis(x,t,k)
+    cols=i[:,None]+np.arange(k+1)
+    rows=np.repeat(np.arange(len(i)),k+1)
+    return sparse.csr_matrix((N.ravel(),(rows,cols.ravel())),shape=(len(i),len(t)-k-1))
+
+def collocation_matrix(x,y,tx,ty,kx,ky):
+    '''
+    Returns the sparse matrix of tensor product B-spline basis functions (knots tx, ty and orders kx, ky) evaluated at each point (x[i],y[i]), with coefficients ordered as per bisplrep. Each row has (kx+1)*(ky+1) non-zero entries.
+    '''
+    nx,ny=len(tx)-kx-1,len(ty)-ky-1
+    ix,Nx=cached_basis(x,tx,kx)
+    iy,Ny=cached_basis(y,ty,ky)
+
+    cols=(ix[:,None,None]+np.arange(kx+1)[None,:,None])*ny+(iy[:,None,None]+np.arange(ky+1)[None,None,:])
+    vals=Nx[:,:,None]*Ny[:,None,:]
+    rows=np.repeat(np.arange(len(ix)),(kx+1)*(ky+1))
+    return sparse.csr_matrix((vals.ravel(),(rows,cols.ravel())),shape=(len(ix),nx*ny))
+
+def bisplev_points(x,y,tck,dx=0,dy=0):
+    '''
+    Evaluates the bivariate B-spline tck, or its partial derivative dx, dy, at each of the scattered points (x[i],y[i]) in a single vectorized call
+    '''
+    tx,ty,c,kx,ky=deriv_tck(tck,dx,dy)
+    ix,Nx=cached_basis(x,tx,kx)
+    iy,Ny=cached_basis(y,ty,ky)
+
+    z=np.zeros(len(ix))
+    for r in range(kx+1):
+        for q in range(ky+1):
+            z+=Nx[:,r]*Ny[:,q]*c[ix+r,iy+q]
+    return z
+
+def bisplev_grid(x,y,tck,dx=0,dy=0):
+    '''
+    Evaluates the bivariate B-spline tck, or its partial derivative dx, dy, on the grid defined by x and y, which need not be sorted. Returns an array len(x) by len(y), as per bisplev.
+    '''
+    tx,ty,c,kx,ky=deriv_tck(tck,dx,dy)
+    Bx=basis_matrix(np.atleast_1d(x),tx,kx)
+    By=basis_matrix(np.atleast_1d(y),ty,ky)
+    return np.asarray(Bx@(By@c.T).T)
+
+def slope(x,y,tck):
+    '''
+    Returns the magnitude of the gradient of tck at the scattered points (x[i],y[i])
+    '''
+    return np.hypot(bisplev_points(x,y,tck,dx=1),bisplev_points(x,y,tck,dy=1))
+
+def spline_knots(rmin,rmax,gx,gy,kx,ky):
+    '''
+    Returns knots for splines of order kx, ky spaced gx and gy between rmin and rmax, repeated at the edges, or None if there are too few knots in either direction
+    '''
+    tx=np.linspace(rmin[0],rmax[0],int((rmax[0]-rmin[0])/gx))
+    ty=np.linspace(rmin[1],rmax[1],int((rmax[1]-rmin[1])/gy))
+    if len(tx)<3 or len(ty)<3:
+        return None
+    tx=np.insert(tx,0,[rmin[0]] * kx) #to make sure knots are repeated at edges
+    tx=np.insert(tx,-1,[rmax[0]] * kx)
+    ty=np.insert(ty,0,[rmin[1]] * ky) #to make sure knots are repeated at edges
+    ty=np.insert(ty,-1,[rmax[1]] * ky)
+    return tx,ty
+
+def spline_penalty(nx,ny):
+    '''
+    Returns the sparse second difference penalty matrix in x and y for nx by ny spline coefficients ordered x major, as per bisplrep
+    '''
+    def penalty(n):
+        if n<3:
+            return sparse.csc_matrix((n,n))
+        D=sparse.diags([1.,-2.,1.],[0,1,2],shape=(n-2,n))
+        return (D.T@D).tocsc()
+    return (sparse.kron(penalty(nx),sparse.identity(ny))+sparse.kron(sparse.identity(nx),penalty(ny))).tocsc()
+
+def penalised(AtA,P,smooth=1e-3):
+    '''
+    Returns normal matrix AtA with penalty P (see spline_penalty) added, weighted by smooth relative to the data
+    '''
+    if P.nnz:
+        return (AtA+smooth*AtA.diagonal().sum()/P.diagonal().sum()*P).tocsc()
+    #no penalty possible, small ridge instead
+    return (AtA+smooth*AtA.diagonal().mean()*sparse.identity(AtA.shape[0])).tocsc()
+
+def solve_normal(K,b,c0=None,lu=None,tol=1e-12,max_iter=20):
+    '''
+    Solves penalised normal equations K c = b for spline coefficients. If previous coefficients c0 and the LU factorisation of a previous, similar K are given, then c0 is improved by iterative refinement with that factorisation until the residual is less than tol relative to b. If this doesn't converge within max_iter iterations, or no previous solution is given, K is factorised. Returns the coefficients and the factorisation.
+    '''
+    if c0 is not None and lu is not None:
+        c=c0.copy()
+        nb=np.linalg.norm(b)
+        rn=np.inf
+        for i in range(max_iter):
+            r=b-K@c
+            rn_new=np.linalg.norm(r)
+            if rn_new<=tol*nb:
+                return c,lu
+            if not rn_new<rn: #diverging, K is too different
+                break
+            rn=rn_new
+            c=c+lu.solve(r)
+    try:
+        lu=splu(K.tocsc())
+        c=lu.solve(b)
+    except RuntimeError:
+        c=np.full(len(b),np.nan)
+    if not np.all(np.isfinite(c)):
+        raise ValueError("Singular system, knot spacing is too fine for the data.")
+    return c,lu
+
+class spline_normal_eq(object):
+    '''
+    Normal equations of a spline fit to the active subset of points p, which are updated by adding or subtracting the contribution of points as they are activated or deactivated rather than being rebuilt
+    '''
+    def __init__(self,p,tx,ty,kx,ky,active,smooth=1e-3):
+        self.tx,self.ty=np.asarray(tx,dtype=float),np.asarray(ty,dtype=float)
+        self.kx,self.ky=kx,ky
+        self.A=collocation_matrix(p[:,0],p[:,1],self.tx,self.ty,kx,ky)
+        self.z=p[:,2]
+        self.active=np.array(active,dtype=bool)
+        Aa=self.A[self.active]
+        self.AtA=(Aa.T@Aa).tocsc()
+        self.Atz=Aa.T@self.z[self.active]
+        self.P=spline_penalty(len(self.tx)-kx-1,len(self.ty)-ky-1)
+        self.smooth=smooth
+        self.c,self.lu=None,None
+    
+    def update(self,ids,add):
+        '''
+        Adds (or removes if add is False) the points with indices ids to the normal equations, ignoring any which are already in that state
+        '''
+        ids=np.asarray(ids)
+        ids=ids[self.active[ids]!=add]
+        if len(ids)==0:
+            return
+        Ai=self.A[ids]
+        sign=1. if add else -1.
+        self.AtA=(self.AtA+sign*(Ai.T@Ai)).tocsc()
+        self.Atz=self.Atz+sign*(Ai.T@self.z[ids])
+        self.active[ids]=add
+    
+    def solve(self):
+        '''
+        Returns tck as per bisplrep for the current active points, the same as fit_spline_sparse to within the tolerance of solve_normal. The last solution and factorisation are refined rather than factorising afresh where possible.
+        '''
+        self.c,self.lu=solve_normal(penalised(self.AtA,self.P,self.smooth),self.Atz,self.c,self.lu)
+        return [self.tx,self.ty,self.c,self.kx,self.ky]
+    
+    def residual(self):
+        '''
+        Returns the difference between the fit and the height of every point, active or not
+        '''
+        return self.A@self.c-self.z
+
+def fit_spline_sparse(p,tx,ty,kx,ky,smooth=1e-3):
+    '''
+    Least squares fit of a bivariate spline with knots tx, ty and orders kx, ky to the Nx3 points p, by solving the sparse normal equations of the collocation matrix. A second difference penalty on the coefficients, weighted by smooth relative to the data, keeps coefficients with little or no supporting data well conditioned. Returns tck as per bisplrep.
+    '''
+    tx,ty=np.asarray(tx,dtype=float),np.asarray(ty,dtype=float)
+    nx,ny=len(tx)-kx-1,len(ty)-ky-1
+    if nx<1 or ny<1:
+        raise ValueError("Too few knots for spline order.")
+    
+    A=collocation_matrix(p[:,0],p[:,1],tx,ty,kx,ky)
+    c,_=solve_normal(penalised(A.T@A,spline_penalty(nx,ny),smooth),A.T@p[:,2])
+    return [tx,ty,c,kx,ky]
+
+#tuning constants of the robust weight functions, beyond which points are downweighted (Huber) or rejected (Tukey)
+robust_constants={'huber':1.345,'tukey':4.685}
+
+def robust_weights(r,method='tukey',floor=0.):
+    '''
+    Returns Huber or Tukey biweight weights for residuals r, scaled by their median absolute deviation or floor if larger, along with the scaled residuals. The floor stops the scale collapsing when most residuals are near zero, such as for noise free data.
+    '''
+    scale=max(1.4826*np.median(np.abs(r-np.median(r))),floor,np.finfo(float).tiny)
+    u=r/scale
+    c=robust_constants[method]
+    if method=='huber':
+        return np.minimum(1.,c/np.maximum(np.abs(u),1e-12)), u
+    return np.where(np.abs(u)<c,(1-(u/c)**2)**2,0.), u
+
+def fit_spline_robust(p,tx,ty,kx,ky,method='tukey',smooth=1e-3,max_iter=20,tol=1e-4):
+    '''
+    Robust fit of a bivariate spline by iteratively reweighted least squares with Huber or Tukey weights (see robust_weights), each weighted solve refining the previous coefficients with the last factorisation (see solve_normal). Iterates until the largest change in coefficients is less than tol relative to the largest coefficient. The residual scale is floored at a tenth of the RMS residual of the initial least squares fit. Returns tck as per bisplrep, the final weights and a boolean array flagging outliers, being points beyond the tuning constant of the method (see robust_constants) in scaled deviations from the fit.
+    '''
+    tx,ty=np.asarray(tx,dtype=float),np.asarray(ty,dtype=float)
+    nx,ny=len(tx)-kx-1,len(ty)-ky-1
+    if nx<1 or ny<1:
+        raise ValueError("Too few knots for spline order.")
+    
+    A=collocation_matrix(p[:,0],p[:,1],tx,ty,kx,ky)
+    P=spline_penalty(nx,ny)
+    z=p[:,2]
+    c,lu=solve_normal(penalised(A.T@A,P,smooth),A.T@z)
+    floor=max(0.1*np.sqrt(np.mean((A@c-z)**2)),1e-9*np.ptp(z))
+    for i in range(max_iter):
+        w,u=robust_weights(A@c-z,method,floor)
+        c_new,lu=solve_normal(penalised(A.T@sparse.diags(w)@A,P,smooth),A.T@(w*z),c,lu)
+        converged=np.max(np.abs(c_new-c))<tol*np.max(np.abs(c_new))
+        c=c_new
+        if converged:
+            break
+    w,u=robust_weights(A@c-z,method,floor)
+    return [tx,ty,c,kx,ky], w, np.abs(u)>=robust_constants[method]
+
+def cosine_vander(u,n):
+    '''
+    Returns the half range (cosine) Fourier series with n harmonics evaluated at u in [-1,1] (len(u) by n+1), having a period of twice the domain so that the surface need not be periodic
+    '''
+    return np.cos(np.pi*(np.asarray(u)+1)[:,None]*np.arange(n+1)/2)
+
+#basis functions along an axis of the global fit models, keyed on their form. Each returns the functions of degree/number n evaluated at u in [-1,1] (len(u) by number of functions).
+fit_models={'Legendre': np.polynomial.legendre.legvander,
+    'Chebyshev': np.polynomial.chebyshev.chebvander,
+    'Fourier': cosine_vander}
+
+class surface_model(object):
+    '''
+    Surface fitted as a linear combination of tensor products of the basis functions of form (see fit_models) with degree/number nx, ny over the rectangular domain [xmin,xmax,ymin,ymax], which is mapped to [-1,1]
+    '''
+    def __init__(self,form,nx,ny,domain,coefs=None):
+        self.form=form
+        self.axis_basis=fit_models[form]
+        self.nx,self.ny=int(nx),int(ny)
+        self.domain=np.asarray(domain,dtype=float).ravel()
+        self.coefs=None if coefs is None else np.asarray(coefs,dtype=float)
+    
+    def bases(self,x,y):
+        '''
+        Returns the axis basis matrices at x and y
+        '''
+        d=self.domain
+        u=2*(np.asarray(x,dtype=float)-d[0])/(d[1]-d[0])-1
+        v=2*(np.asarray(y,dtype=float)-d[2])/(d[3]-d[2])-1
+        return self.axis_basis(u,self.nx), self.axis_basis(v,self.ny)
+    
+    def design(self,x,y):
+        '''
+        Returns the design matrix of tensor product basis functions at the scattered points (x[i],y[i])
+        '''
+        Bx,By=self.bases(x,y)
+        return (Bx[:,:,None]*By[:,None,:]).reshape(len(Bx),-1)
+    
+    def fit(self,p,batch=100000):
+        '''
+        Least squares fit to the Nx3 points p. The design matrix is built batch points at a time and reduced by successive QR factorisations, so memory is independent of the number of points.
+        '''
+        if len(p)==0:
+            raise ValueError("No points to fit.")
+        #triangular factor of the design matrix augmented with heights, its last column holds Q'z
+        R=np.zeros((0,0))
+        for i in range(0,len(p),batch):
+            A=np.column_stack((self.design(p[i:i+batch,0],p[i:i+batch,1]),p[i:i+batch,2]))
+            R=np.linalg.qr(np.vstack((R,A)) if len(R) else A,mode='r')
+        m=R.shape[1]-1
+        Bx,By=self.bases(self.domain[:1],self.domain[2:3])
+        self.coefs=np.linalg.lstsq(R[:m,:m],R[:m,m],rcond=None)[0].reshape(Bx.shape[1],By.shape[1])
+        return self
+    
+    def eval_points(self,x,y,batch=100000):
+        '''
+        Evaluates the surface at each of the scattered points (x[i],y[i])
+        '''
+        z=np.empty(len(x))
+        for i in range(0,len(x),batch):
+            Bx,By=self.bases(x[i:i+batch],y[i:i+batch])
+            z[i:i+batch]=np.einsum('ij,jk,ik->i',Bx,self.coefs,By)
+        return z
+    
+    def eval_grid(self,x,y):
+        '''
+        Evaluates the surface on the grid defined by x and y, returning an array len(x) by len(y) as per bisplev
+        '''
+        Bx,By=self.bases(x,y)
+        return Bx@self.coefs@By.T
+    
+    def to_mat(self):
+        '''
+        Returns a dictionary describing the model for writing to a *.mat file
+        '''
+        return {'form': self.form, 'order': np.array([self.nx,self.ny]), 'domain': self.domain, 'coefs': self.coefs}
+
+class bspline_model(object):
+    '''
+    Wraps tck, as returned by bisplrep or the spline fitting functions, with the same evaluation interface as surface_model
+    '''
+    form='B-'
+    def __init__(self,tck):
+        self.tck=tck
+    
+    def eval_points(self,x,y):
+        return bisplev_points(x,y,self.tck)
+    
+    def eval_grid(self,x,y):
+        return bisplev_grid(x,y,self.tck)
+
+def read_fit_model(mat_contents):
+    '''
+    Returns the fitted surface stored in mat_contents, as a bspline_model if a spline_x structure is present, a surface_model if a fit_x structure is present, otherwise None
+    '''
+    if 'spline_x' in mat_contents:
+        bsplinerep=mat_contents['spline_x']['tck'][0][0]
+        #recast tck as a tuple
+        tck=tuple()
+        for j in range(5):
+            tck=tck+tuple(bsplinerep[0,j])
+        return bspline_model(tck)
+    if 'fit_x' in mat_contents:
+        s=mat_contents['fit_x']
+        order=s['order'][0][0].ravel()
+        return surface_model(str(s['form'][0][0][0]),order[0],order[1],s['domain'][0][0],s['coefs'][0][0])
+    return None
@@ -0,0 +1,58 @@
+'''
+Tests of VTK helpers in pyCM.pyCMcommon, which are skipped if vtk, PyQt5 or the other dependencies of that module aren't available
+'''
+import numpy as np
+import pytest
+
+common=pytest.importorskip('pyCM.pyCMcommon')
+import vtk
+from pyCM import mesher
+
+def test_scalar_point_cloud_has_a_vertex_per_point():
+    pts=np.random.RandomState(0).rand(50,3)
+    pC,_,_=common.gen_scalar_point_cloud(pts,pts[:,2],3)
+    assert pC.GetNumberOfVerts()==len(pts)
+    assert [pC.GetCell(i).GetPointId(0) for i in (0,17,49)]==[0,17,49]
+
+def test_grid_round_trip():
+    rng=np.random.RandomState(0)
+    points=rng.rand(30,3)
+    conn=np.array([rng.permutation(30)[:4] for i in range(12)])
+    grid=common.numpy_to_grid(points,conn,10)
+    assert grid.GetNumberOfCells()==len(conn)
+    assert np.all(common.cell_types(grid)==10)
+    found,cells=common.cell_connectivity(grid,10)
+    assert np.array_equal(found,conn) and np.array_equal(cells,np.arange(len(conn)))
+    assert len(common.cell_connectivity(grid,12)[1])==0
+    sub=common.extract_cell_type(grid,10)
+    assert sub.GetNumberOfPoints()==len(np.unique(conn))
+
+def test_cell_connectivity_of_mixed_grid():
+    points=vtk.vtkPoints()
+    for p in np.random.RandomState(1).rand(8,3):
+        points.InsertNextPoint(p)
+    grid=vtk.vtkUnstructuredGrid()
+    grid.SetPoints(points)
+    grid.Allocate(3)
+    for cell_type,ids in ((10,[0,1,2,3]),(5,[1,2,3]),(10,[4,5,6,7])):
+        idList=vtk.vtkIdList()
+        for i in ids:
+            idList.InsertNextId(i)
+        grid.InsertNextCell(cell_type,idList)
+    assert np.array_equal(common.cell_types(grid),[10,5,10])
+    conn,cells=common.cell_connectivity(grid,10)
+    assert np.array_equal(conn,[[0,1,2,3],[4,5,6,7]]) and np.array_equal(cells,[0,2])
+    assert np.array_equal(common.cell_connectivity(grid,5)[0],[[1,2,3]])
+
+def test_mesh_topology_of_extruded_mesh():
+    outline=np.array([[0,0],[2,0],[2,1],[0,1]],dtype=float)
+    outline=np.vstack([np.linspace(a,b,10,endpoint=False) for a,b in zip(outline,np.roll(outline,-1,axis=0))])
+    nodes,quads=mesher.quad_mesh_outline(outline,0.25)
+    pts,conn=mesher.extrude_quads(nodes,quads,np.linspace(0,1,4))
+    topo=common.mesh_topology(common.numpy_to_grid(pts,conn,12),12)
+    assert len(topo.cut['faces'])==len(quads)
+    assert len(topo.back['faces'])==len(quads)
+    assert np.all(pts[topo.cut['faces'],2]==0)
+    assert np.allclose(pts[topo.back['faces'],2],1)
+    assert len(topo.cut['elements'])==len(quads)
+    assert np.array_equal(np.sort(topo.cells_within_z(-0.1,0.1)),np.arange(len(quads)))
@@ -0,0 +1,40 @@
+'''
+Tests of the numpy-only geometric helpers in pyCM.geometry
+'''
+import numpy as np
+from matplotlib import path
+from pyCM import geometry
+
+def test_poly_mask_matches_path():
+    a=np.linspace(0,2*np.pi,37)[:-1]
+    r=1+0.4*np.cos(5*a)
+    poly=np.column_stack((r*np.cos(a),r*np.sin(a)))
+    x,y=np.linspace(-1.5,1.5,61),np.linspace(-1.4,1.4,53)
+    X,Y=np.meshgrid(x,y)
+    expected=path.Path(poly).contains_points(np.column_stack((X.ravel(),Y.ravel()))).reshape(X.shape)
+    assert np.array_equal(geometry.poly_mask(poly,x,y),expected)
+    #closing the polygon makes no difference
+    assert np.array_equal(geometry.poly_mask(np.vstack((poly,poly[0])),x,y),expected)
+
+def test_compose_trans_matches_sequential():
+    rng=np.random.RandomState(0)
+    P=rng.rand(100,3)
+    trans=[]
+    for angle,t in ((0.3,[1,0,0]),(-1.1,[0,2,0.5]),(2.0,[0.1,0.1,0.1])):
+        T=np.identity(4)
+        T[0:2,0:2]=[[np.cos(angle),np.sin(angle)],[-np.sin(angle),np.cos(angle)]]
+        T[0:3,-1]=t
+        trans.append(T)
+    #as applied by apply_trans
+    expected=P
+    for T in trans:
+        expected=np.dot(expected,T[0:3,0:3])+T[0:3,-1]
+    T=geometry.compose_trans(trans)
+    assert np.allclose(np.dot(P,T[0:3,0:3])+T[0:3,-1],expected)
+    assert np.array_equal(geometry.compose_trans([]),np.identity(4))
+
+def test_nn_spacing_of_grid():
+    x,y=np.meshgrid(np.arange(20)*0.5,np.arange(30)*0.5)
+    pts=np.column_stack((x.ravel(),y.ravel()))
+    assert np.isclose(geometry.nn_spacing(pts),0.5)
+    assert np.isclose(geometry.nn_spacing(pts,sample=50),0.5)
@@ -0,0 +1,41 @@
+'''
+Tests of the in-process quad/hex mesher in pyCM.mesher
+'''
+import numpy as np
+from pyCM import mesher
+
+def l_outline(n=20):
+    '''
+    Returns an ordered, unclosed L-shaped outline with n points per unit edge
+    '''
+    corners=np.array([[0,0],[4,0],[4,1],[1,1],[1,3],[0,3],[0,0]],dtype=float)
+    pts=[np.linspace(a,b,int(n*np.linalg.norm(b-a)),endpoint=False) for a,b in zip(corners[:-1],corners[1:])]
+    return np.vstack(pts)
+
+def test_quad_mesh_covers_outline():
+    nodes,quads=mesher.quad_mesh_outline(l_outline(),0.2)
+    q=nodes[quads]
+    area=0.5*(mesher.cross2d(q[:,1]-q[:,0],q[:,3]-q[:,0])+mesher.cross2d(q[:,3]-q[:,2],q[:,1]-q[:,2]))
+    assert np.all(area>0)
+    assert np.isclose(area.sum(),6.0)
+
+def test_extruded_hexes_not_inverted():
+    nodes,quads=mesher.quad_mesh_outline(l_outline(),0.2)
+    z=np.concatenate(([0],mesher.layer_distribution(0.1,5,2.)*2.))
+    pts,conn=mesher.extrude_quads(nodes,quads,z)
+    assert len(conn)==5*len(quads)
+    h=pts[conn]
+    #jacobian at each corner of the bottom and top faces, being the two in-plane edges and the edge through the thickness
+    for layer in (0,4):
+        for i in range(4):
+            p=h[:,layer+i]
+            a=h[:,layer+(i+1)%4]-p
+            b=h[:,layer+(i+3)%4]-p
+            c=h[:,i+4]-h[:,i]
+            assert np.all(np.einsum('ij,ij->i',np.cross(a,b),c)>0)
+
+def test_layer_distribution():
+    L=mesher.layer_distribution(0.1,8,2.)
+    assert np.isclose(L[-1],1.)
+    assert np.all(np.diff(np.concatenate(([0],L)))>0)
+    assert np.isclose(L[0]*2.,0.1,rtol=0.05)
@@ -0,0 +1,63 @@
+'''
+Tests of spline evaluation and fitting in pyCM.spline against scipy
+'''
+import numpy as np
+from scipy.interpolate import bisplrep, bisplev
+from pyCM import spline
+
+def surface(n=2000,seed=0):
+    '''
+    Returns n scattered points on a smooth surface over [0,10]x[0,5]
+    '''
+    rng=np.random.RandomState(seed)
+    x,y=rng.rand(n)*10,rng.rand(n)*5
+    return np.column_stack((x,y,np.sin(x/3)*np.cos(y/2)+0.01*x*y))
+
+def test_bisplev_matches_scipy():
+    p=surface()
+    tck=bisplrep(p[:,0],p[:,1],p[:,2],kx=3,ky=2,s=0.1)
+    x,y=np.linspace(0,10,23),np.linspace(0,5,17)
+    assert np.allclose(spline.bisplev_grid(x,y,tck),bisplev(x,y,tck))
+    assert np.allclose(spline.bisplev_grid(x,y,tck,dx=1),bisplev(x,y,tck,dx=1))
+    assert np.allclose(spline.bisplev_points(p[:,0],p[:,1],tck),
+        [bisplev(a,b,tck) for a,b in p[:,:2]])
+
+def test_cached_basis_clear():
+    x=np.linspace(0,10,50)
+    t=np.concatenate(([0.]*3,np.linspace(0,10,6),[10.]*3))
+    first=spline.cached_basis(x,t,3)
+    assert spline.cached_basis(x,t,3) is first
+    x*=0.5
+    spline.clear_cache()
+    assert np.allclose(spline.cached_basis(x,t,3)[1],spline.bspl_basis(x,t,3)[1])
+
+def test_incremental_refit_matches_fresh_fit():
+    p=surface(5000)
+    tx,ty=spline.spline_knots([0,0],[10,5],1,1,3,3)
+    state=spline.spline_normal_eq(p,tx,ty,3,3,np.ones(len(p),dtype=bool))
+    state.solve()
+    state.update(np.nonzero(p[:,0]<2)[0],False)
+    c=state.solve()[2]
+    assert np.allclose(c,spline.fit_spline_sparse(p[state.active],tx,ty,3,3)[2],atol=1e-9)
+
+def test_robust_fit_flags_outliers():
+    p=surface(5000)
+    p[:20,2]+=1
+    tx,ty=spline.spline_knots([0,0],[10,5],1,1,3,3)
+    _,_,outliers=spline.fit_spline_robust(p,tx,ty,3,3,method='tukey')
+    assert np.all(outliers[:20]) and not np.any(outliers[20:])
+
+def test_global_models_round_trip(tmp_path):
+    import scipy.io as sio
+    rng=np.random.RandomState(0)
+    p=rng.rand(3000,3)*[10,5,0]
+    p[:,2]=1+0.2*p[:,0]-0.1*p[:,1]**2+0.01*p[:,0]**2*p[:,1]
+    x,y=np.linspace(0,10,7),np.linspace(0,5,4)
+    for form in spline.fit_models:
+        model=spline.surface_model(form,4,4,[0,10,0,5]).fit(p)
+        if form!='Fourier': #polynomials reproduce the surface exactly
+            assert np.allclose(model.eval_points(p[:,0],p[:,1]),p[:,2])
+        sio.savemat(str(tmp_path/'fit.mat'),{'fit_x':model.to_mat()})
+        read=spline.read_fit_model(sio.loadmat(str(tmp_path/'fit.mat')))
+        assert read.form==form
+        assert np.allclose(read.eval_grid(x,y),model.eval_grid(x,y))